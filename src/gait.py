@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+
+##
+# @file         gait.py
+# @author       agent
+# @version      0.0.0-r0
+# @since        26-10-19
+#
+# @brief        Generates gait Programs from parametric templates and keeps the recent ones in a cache.
+#
+# A template turns a set of parameters into the foot trajectories of one gait cycle, which are
+# solved by the ik module. The parameters are normalized (defaults filled in, values converted
+# to the type of the default), so equal gaits always hit the same cache entry.
+##
+
+#
+# IMPORTS
+#
+import collections
+import numpy
+
+import ik
+
+#
+# PRIVATE VARIABLES and FUNCTIONS
+#
+
+##
+# The phase offset of every leg per leg pattern.
+_PATTERNS = {
+        'crawl': [0.0, 0.5, 0.25, 0.75],
+        'trot': [0.0, 0.5, 0.5, 0.0],
+}
+
+##
+# Computes the foot positions of all legs over one cycle.
+# During the stance (the first `duty` part of the cycle) a foot moves backwards on the ground,
+# during the swing it moves forward on a sine arc of the given height.
+# @param p      the normalized parameters
+# @param dirs   the direction of the stride of every leg, 1 forward and -1 backwards
+# @returns      the foot positions with shape (frames, 4, 3)
+def _cycle(p, dirs):
+        frames = p['frames']
+        phase = (numpy.arange(frames)[:, None]/float(frames) + numpy.array(_PATTERNS[p['pattern']])[None, :]) % 1.0
+        duty = p['duty']
+        stance = phase < duty
+        s_stance = phase/duty
+        s_swing = (phase - duty)/(1.0 - duty)
+        half = p['stride']/2.0
+        x = numpy.where(stance, half - 2.0*half*s_stance, -half + 2.0*half*s_swing)
+        z = numpy.where(stance, p['depth'], p['depth'] + p['height']*numpy.sin(numpy.pi*s_swing))
+        feet = numpy.empty((frames, 4, 3))
+        feet[..., 0] = x*numpy.array(dirs)[None, :]
+        feet[..., 1] = p['width']
+        feet[..., 2] = z
+        return feet
+
+def _walk(p):
+        return _cycle(p, [1, 1, 1, 1])
+
+def _turn(p):
+        return _cycle(p, [1, 1, -1, -1])
+
+#
+# CLASSES
+#
+
+##
+# The known gait templates, each with its generator and the default of every parameter.
+# stride, height, width and depth are in mm, cycle is the duration of one cycle in ms.
+TEMPLATES = {
+        'walk': (_walk, {'stride': 40.0, 'height': 20.0, 'width': 80.0, 'depth': -60.0, 'cycle': 1000, 'frames': 20, 'duty': 0.75, 'pattern': 'crawl'}),
+        'turn': (_turn, {'stride': 30.0, 'height': 20.0, 'width': 80.0, 'depth': -60.0, 'cycle': 1000, 'frames': 20, 'duty': 0.75, 'pattern': 'crawl'}),
+}
+
+##
+# Generates gait Programs and caches them, least recently used entries are evicted first.
+class GaitCache:
+
+        SIZE = 32
+        PREFIX = 'gait:'
+
+        ##
+        # @param geom   the LegGeometry to solve with
+        # @param size   the maximum number of cached Programs
+        def __init__(self, geom = None, size = SIZE):
+                if geom == None:
+                        geom = ik.LegGeometry()
+                self.geom = geom
+                self.size = size
+                self.cache = collections.OrderedDict()
+                self.hits = 0
+                self.misses = 0
+
+        def __repr__(self):
+                rate = 0.0
+                if self.hits + self.misses > 0:
+                        rate = self.hits/float(self.hits + self.misses)
+                return 'GaitCache()[size=' + str(len(self.cache)) + '/' + str(self.size) + ', hits=' + str(self.hits) + ', misses=' + str(self.misses) + ', hit_rate=' + ('%.2f' % rate) + ']'
+
+        ##
+        # Fills in the defaults and converts the values to their types.
+        # Raises a ValueError for unknown templates, parameters or malformed values.
+        # @param kind   the name of the template
+        # @param params a dict of parameter names to values (strings are fine)
+        # @returns      the normalized parameters as sorted tuple of (name, value)
+        def normalize(self, kind, params):
+                if not kind in TEMPLATES:
+                        raise ValueError('no such gait: ' + kind)
+                defaults = TEMPLATES[kind][1]
+                p = dict(defaults)
+                for (k, v) in params.items():
+                        if not k in defaults:
+                                raise ValueError('no such parameter: ' + k)
+                        p[k] = type(defaults[k])(v)
+                if p['frames'] < 2 or p['cycle'] < p['frames'] or not (0.0 < p['duty'] < 1.0) or not p['pattern'] in _PATTERNS:
+                        raise ValueError('invalid parameters for ' + kind)
+                return tuple(sorted(p.items()))
+
+        ##
+        # Returns the Program for a gait, generating it if it isn't cached.
+        # The name of the Program is `gait:<kind>:<name>=<value>,...`, see PREFIX.
+        # @param kind   the name of the template
+        # @param params a dict of parameter names to values
+        # @returns      the Program, its frames are encoded
+        def get(self, kind, params):
+                norm = self.normalize(kind, params)
+                key = (kind, norm)
+                if key in self.cache:
+                        self.hits += 1
+                        prg = self.cache.pop(key)
+                        self.cache[key] = prg
+                        return prg
+                self.misses += 1
+                p = dict(norm)
+                name = GaitCache.PREFIX + kind + ':' + ','.join([k + '=' + str(v) for (k, v) in norm])
+                prg = ik.gaitProgram(name, self.geom, TEMPLATES[kind][0](p), p['cycle'] // p['frames'])
+                self.cache[key] = prg
+                while len(self.cache) > self.size:
+                        self.cache.popitem(last = False)
+                return prg
+
+        ##
+        # Removes the gait Programs which are no longer cached from a register of programs, so
+        # evicting an entry frees its Program.
+        # @param prgs   the dict of names to Programs, like FileWalker.prgs
+        # @param keep   the names of the Programs to keep even if they are evicted, like the selected
+        #               one or the ones in a playlist
+        # @returns      the number of removed Programs
+        def prune(self, prgs, keep):
+                keep = set(keep)
+                keep.update([prg.name for prg in self.cache.values()])
+                names = [name for name in prgs if name.startswith(GaitCache.PREFIX) and not name in keep]
+                for name in names:
+                        del prgs[name]
+                return len(names)
@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+
+##
+# @file         ik.py
+# @author       agent
+# @version      0.0.0-r0
+# @since        26-10-19
+#
+# @brief        Inverse kinematics for the four legs of CAiRO, solved for a whole gait cycle at once.
+#
+# Every leg has three joints (coxa, femur, tibia), servo `3*leg + joint` drives joint `joint` of
+# leg `leg`. Foot positions are given in the frame of their leg: the origin is the coxa joint,
+# y points away from the body, x forward and z up. All frames of all legs are solved in one batch
+# with numpy and converted into Steps using Step.setStepsRad().
+##
+
+#
+# IMPORTS
+#
+import numpy
+
+import logger
+import walkietalkie
+
+#
+# CLASSES
+#
+
+##
+# The dimensions of a leg and the mounting of its servos.
+# The servo angle of a joint is `zero + sign*joint_angle`, with the joint angles being:
+# - coxa:  the rotation around z, zero (0) when the leg points straight away from the body
+# - femur: the elevation of the femur, zero (0) when it is horizontal
+# - tibia: the inner angle of the knee, pi when the leg is stretched
+class LegGeometry:
+
+        LEGS = 4
+        JOINTS = 3
+
+        ##
+        # @param coxa   the length of the coxa in mm
+        # @param femur  the length of the femur in mm
+        # @param tibia  the length of the tibia in mm
+        def __init__(self, coxa = 30.0, femur = 50.0, tibia = 70.0):
+                self.coxa = float(coxa)
+                self.femur = float(femur)
+                self.tibia = float(tibia)
+                self.zero = numpy.tile(numpy.radians([95.0, 95.0, 0.0]), (LegGeometry.LEGS, 1))
+                self.sign = numpy.ones((LegGeometry.LEGS, LegGeometry.JOINTS))
+
+        def __repr__(self):
+                return 'LegGeometry()[coxa=' + str(self.coxa) + ', femur=' + str(self.femur) + ', tibia=' + str(self.tibia) + ']'
+
+#
+# FUNCTIONS
+#
+
+##
+# Solves the servo angles for a sequence of foot positions.
+# Positions out of reach are moved to the closest reachable configuration and reported in the mask.
+# @param geom   the LegGeometry
+# @param feet   an array of shape (frames, 4, 3) holding the x, y, z position of every foot
+# @returns      the servo angles in rad with shape (frames, 12) and the unreachable mask (frames, 4)
+def solve(geom, feet):
+        feet = numpy.asarray(feet, dtype = float)
+        x = feet[..., 0]
+        y = feet[..., 1]
+        z = feet[..., 2]
+
+        coxa = numpy.arctan2(x, y)
+        r = numpy.hypot(x, y) - geom.coxa
+        d2 = r*r + z*z
+        d = numpy.sqrt(d2)
+
+        with numpy.errstate(divide = 'ignore', invalid = 'ignore'):
+                cos_knee = (geom.femur**2 + geom.tibia**2 - d2)/(2.0*geom.femur*geom.tibia)
+                cos_lift = (geom.femur**2 + d2 - geom.tibia**2)/(2.0*geom.femur*d)
+        cos_lift = numpy.where(d > 0, cos_lift, 1.0)
+        unreachable = (numpy.abs(cos_knee) > 1.0) | (numpy.abs(cos_lift) > 1.0) | (d <= 0)
+
+        femur = numpy.arctan2(z, r) + numpy.arccos(numpy.clip(cos_lift, -1.0, 1.0))
+        tibia = numpy.arccos(numpy.clip(cos_knee, -1.0, 1.0))
+
+        joints = numpy.stack([coxa, femur, tibia], axis = -1)
+        servos = geom.zero + geom.sign*joints
+        return servos.reshape(feet.shape[0], LegGeometry.LEGS*LegGeometry.JOINTS), unreachable
+
+##
+# Creates a 'prg' Program from servo angles, one Step per frame.
+# @param name   the name of the Program
+# @param angles the servo angles in rad with shape (frames, 12)
+# @param delay  the delay of every Step in ms
+# @param looping wheter the Program loops
+# @returns      the Program
+def toProgram(name, angles, delay, looping = True):
+        prg = walkietalkie.Program('<ik:' + name + '>')
+        prg.name = name
+        prg.tick = int(delay)
+        prg.looping = looping
+        prg.use = 'prg'
+        for row in angles.tolist():
+                stp = walkietalkie.Step()
+                stp.setStepsRad(row)
+                stp.setDelayMs(int(delay))
+                prg.prg_steps.append(stp)
+        prg.encode()
+        return prg
+
+##
+# Solves a gait cycle and creates a Program from it, see solve() and toProgram().
+# @param name   the name of the Program
+# @param geom   the LegGeometry
+# @param feet   the foot positions with shape (frames, 4, 3)
+# @param delay  the delay of every Step in ms
+# @param looping wheter the Program loops
+# @returns      the Program
+def gaitProgram(name, geom, feet, delay, looping = True):
+        angles, unreachable = solve(geom, feet)
+        n = int(numpy.count_nonzero(unreachable))
+        if n > 0:
+                logger.DefaultLogger.warn(str(n) + ' foot positions of ' + name + ' are out of reach')
+        return toProgram(name, angles, delay, looping)
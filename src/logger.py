@@ -8,6 +8,9 @@
 # 
 # @brief        A simple and easy to use logging system, which prints date
 #               and level of the logged information and optionally does log everything to a file.
+#
+# Every record of every level is kept in an in-memory ring as well, regardless of the levels
+# set, so the context of an incident can be dumped afterwards without flooding the output.
 ##
 
 #
@@ -15,6 +18,7 @@
 #
 import sys
 import time
+import collections
 
 #
 # PRIVATE VARIABLES and FUNCTIONS
@@ -48,8 +52,14 @@ class LoggingLevel:
 ##
 # The Logger has some default builtin methods for pretty-printing log messages.
 # The messages are in the form of `[<LOGINFO>][<date>]: message`.
+# The last RING_LEN records are kept in memory and written by dump().
 class Logger:
 
+        RING_LEN = 4096
+        ##
+        # The default file name of a dump, formatted with time.strftime().
+        DUMP_NAME = 'logdump-%Y%m%d-%H%M%S.log'
+
         LVL_DBUG = LoggingLevel(0, 'DBUG')
         LVL_INFO = LoggingLevel(1, CCODES.OKBLUE + 'INFO' + CCODES.ENDC)
         LVL_WARN = LoggingLevel(2, CCODES.WARNING + 'WARN' + CCODES.ENDC)
@@ -59,6 +69,9 @@ class Logger:
                 self.level = 0
                 self.filelvl = 0
                 self.file = None
+                self.ring = collections.deque(maxlen = Logger.RING_LEN)
+                self.date_sec = -1
+                self.date = ''
 
         ##
         # Sets the level of this Logger to lvl.
@@ -81,13 +94,37 @@ class Logger:
                         self.file.close()
                         self.file = None
 
+        ##
+        # Sets the number of records kept in memory, the most recent ones are kept.
+        # @param size   the number of records
+        def setRingSize(self, size):
+                self.ring = collections.deque(self.ring, maxlen = size)
+
+        ##
+        # Writes all records kept in memory to a file.
+        # @param path   the file, if None a new file named after DUMP_NAME is created
+        # @returns      the path of the file
+        def dump(self, path = None):
+                if path == None:
+                        path = time.strftime(Logger.DUMP_NAME)
+                recs = list(self.ring)
+                with open(path, 'w') as f:
+                        for rec in recs:
+                                f.write(rec + '\n')
+                return path
+
         ##
         # Print a generic log message, where ll is the loglevel as string and msg is the message to display.
+        # The message is always kept in memory, but only printed if its level is high enough.
         # @param ll     the level name
         # @param msg    the message to display
         def log(self, ll, msg):
-                date = time.strftime('%Y-%m-%d/%H:%M:%S')
-                string = '[' + ll.name + '][' + date + ']:' + msg
+                now = int(time.time())
+                if now != self.date_sec:
+                        self.date = time.strftime('%Y-%m-%d/%H:%M:%S', time.localtime(now))
+                        self.date_sec = now
+                string = '[' + ll.name + '][' + self.date + ']:' + msg
+                self.ring.append(string)
                 if ll.lvl >= self.level:
                         sys.stdout.write(string + '\n')
                         sys.stdout.flush()
@@ -10,11 +10,21 @@ import walkietalkie
 # import uart
 import logger
 import cmd_line
+import supervisor
 import threading
 import time
+import traceback
 
 
 
+##
+# Opens a device for reading and writing, so the responses of the PiCs can be read back.
+# Anything which isn't there yet is created write-only, like before.
+def openDevice(path):
+        if os.path.exists(path):
+                return open(path, 'r+b', buffering=0)
+        return open(path, 'wb')
+
 
 
 arg_sel = 'NONE'
@@ -24,8 +34,11 @@ port = 11111
 s_infile = '-'
 s_outfile = '-'
 s_errfile = '-'
-s_device = None
+s_devices = []
 s_walkdir = './walkfiles/'
+s_calibdir = None
+s_config = None
+m_port = None
 
 # parse cmd line options !!!
 for arg in sys.argv:
@@ -43,6 +56,12 @@ for arg in sys.argv:
                         arg_sel = 'DEVICE'
                 elif arg == '-w':
                         arg_sel = 'WALKFILES'
+                elif arg == '-c':
+                        arg_sel = 'CALIBRATION'
+                elif arg == '-s':
+                        arg_sel = 'SUPERVISOR'
+                elif arg == '-m':
+                        arg_sel = 'METRICS'
                 elif arg == '-h':
                         print("server for loading and executing walkfiles")
                         print('args:')
@@ -56,8 +75,16 @@ for arg in sys.argv:
                         print('  e ... error, refere to -i')
                         print('  d ... device, specify the rs-232 device for')
                         print('        for issueing commands to the servos')
+                        print('        may be given several times as <device>:<pic>[,<pic>...]')
+                        print('        to drive each subset of pics on its own bus')
                         print('  w ... specify the directory to be searched for')
                         print('        walkfiles')
+                        print('  c ... calibration, specify the directory containing')
+                        print('        the servo<N>.cal files')
+                        print('  s ... supervisor, run one controller process per')
+                        print('        robot listed in the given config file')
+                        print('  m ... metrics, serve the metrics over http on')
+                        print('        the given port')
                         print('  h ... help, print this dialog')
                         sys.exit(0)
         else:
@@ -70,9 +97,15 @@ for arg in sys.argv:
                 elif arg_sel == 'ERRFILE':
                         s_errfile = arg
                 elif arg_sel == 'DEVICE':
-                        s_device = arg
+                        s_devices.append(arg)
                 elif arg_sel == 'WALKFILES':
                         s_walkdir = arg
+                elif arg_sel == 'CALIBRATION':
+                        s_calibdir = arg
+                elif arg_sel == 'SUPERVISOR':
+                        s_config = arg
+                elif arg_sel == 'METRICS':
+                        m_port = int(arg)
                 arg_sel = 'NONE'
 
 
@@ -118,10 +151,11 @@ else:
                 f_errfile = sys.stderr
 
 
+# debug records are only kept in memory, see the logdump command
 log_ = logger.Logger()
-log_.setLevel(0)
+log_.setLevel(1)
 if f_outfile != sys.stdout:
-        log_.setLogfile(f_outfile , 0)
+        log_.setLogfile(f_outfile , 1)
 
 cmd_hdlr = cmd_line.CmdHandler(name = 'mc', infile = f_infile, outfile = f_outfile, errfile = f_errfile)
 
@@ -129,47 +163,137 @@ cmd_hdlr = cmd_line.CmdHandler(name = 'mc', infile = f_infile, outfile = f_outfi
 
 
 
-# set up uart connection to motors
-log_.info('Opening uart connection on: ' + str(s_device) + '...')
-if s_device == None:
-        log_.warn("No uart device specified")
-
-# ua = uart.Uart(s_device)
-ua = open(str(s_device), 'wb')
-#if ua.open():
-#        log_.info('done')
-#else:
-#        log_.err('fail')
+##
+# Creates the MotorDistributor for the given device specifications, see -d.
+# @param devices        the list of device specifications
+# @returns              the MotorDistributor
+def createDistributor(devices):
+        if len(devices) == 0:
+                log_.warn("No uart device specified")
+                devices = [str(None)]
 
-# set up motor distributor
-log_.info('Creating motor distributor...')
-md = walkietalkie.MotorDistributor(ua)
-# md = walkietalkie.MotorDistributor(f_outfile)
-log_.info('done')
+        if len(devices) == 1 and not ':' in devices[0]:
+                log_.info('Opening uart connection on: ' + devices[0] + '...')
+                # ua = uart.Uart(s_device)
+                ua = openDevice(devices[0])
+                #if ua.open():
+                #        log_.info('done')
+                #else:
+                #        log_.err('fail')
 
-# set up file walker and load programs
-log_.info('Creating file walker...')
-fw = walkietalkie.FileWalker(md, log_)
-log_.info('done')
-log_.info('Loading programs from \'' + s_walkdir + '\' ...')
-if not os.path.isdir(s_walkdir):
-        log_.err('fail: no such directory')
-else:
-        for f in os.listdir(s_walkdir):
+                # set up motor distributor
+                log_.info('Creating motor distributor...')
+                md = walkietalkie.MotorDistributor(ua)
+                # md = walkietalkie.MotorDistributor(f_outfile)
+                log_.info('done')
+        else:
+                buses = []
+                for spec in devices:
+                        dev_pics = spec.rsplit(':', 1)
+                        pics = [1, 2, 3]
+                        if len(dev_pics) == 2:
+                                pics = [int(p) for p in dev_pics[1].split(',') if len(p) > 0]
+                        log_.info('Opening uart connection on: ' + dev_pics[0] + ' for pics ' + str(pics) + '...')
+                        buses.append((walkietalkie.MotorDistributor(openDevice(dev_pics[0])), pics))
+                log_.info('Creating motor distributor for ' + str(len(buses)) + ' buses...')
+                md = walkietalkie.MultiDistributor(buses)
+                log_.info('done')
+
+        if md.startReader():
+                log_.info('reading back uart responses')
+        if md.startWriter():
+                log_.info('writing to uart in the background')
+        return md
+
+##
+# Loads all walkfiles of a directory into the FileWalker.
+# @param fw             the FileWalker
+# @param walkdir        the directory to search
+def loadPrograms(fw, walkdir):
+        log_.info('Loading programs from \'' + walkdir + '\' ...')
+        if not os.path.isdir(walkdir):
+                log_.err('fail: no such directory')
+                return
+        for f in os.listdir(walkdir):
             if f.endswith(".walk"):
                 log_.info('found file: ' + f)
                 log_.info('trying to load...')
-                if fw.loadProgram(s_walkdir + f):
+                if fw.loadProgram(os.path.join(walkdir, f)):
                         log_.info('loaded')
                 else:
                         log_.warn('failed')
 
-ser = server2.Server(port, cmd_hdlr, log_)
-ser.setFilewalker(fw)
-
-while ser.cmd_hdlr.looping:
-        ser.do()
+##
+# Sets up and runs one controller until it is exited.
+# @param port           the port of the server
+# @param devices        the device specifications, see -d
+# @param walkdir        the directory of the walkfiles
+# @param cmd_hdlr       the CmdHandler of the server
+# @param library        the programs to use instead of loading walkdir, they are shared and not modified
+# @param heartbeat      a shared value, which is set to the current time on every loop
+# @param metrics        the port of the metrics listener, None for none
+def runController(port, devices, walkdir, cmd_hdlr, library = None, heartbeat = None, metrics = None):
+        md = createDistributor(devices)
+
+        # set up file walker and load programs
+        log_.info('Creating file walker...')
+        fw = walkietalkie.FileWalker(md, log_)
+        log_.info('done')
+        if library != None:
+                fw.prgs = dict(library)
+                log_.info('using ' + str(len(fw.prgs)) + ' programs from the shared library')
+        else:
+                loadPrograms(fw, walkdir)
+
+        ser = server2.Server(port, cmd_hdlr, log_)
+        ser.setFilewalker(fw)
+        if metrics != None:
+                ser.startMetrics(metrics)
+
+        try:
+                while ser.cmd_hdlr.looping:
+                        ser.do()
+                        if heartbeat != None:
+                                heartbeat.value = time.time()
+        except Exception:
+                log_.err(traceback.format_exc())
+                log_.err('fatal error, log written to: ' + log_.dump())
+                raise
+
+        if ser.cliIsConn():
+                ser.cli.close()
+        ser.ss.close()
+
+##
+# The process body of a supervised robot.
+# @param robot          the supervisor.Robot to run
+# @param heartbeat      the shared heartbeat value of the robot
+def runRobot(robot, heartbeat):
+        hdlr = cmd_line.CmdHandler(name = robot.name, infile = None, outfile = None, errfile = None)
+        runController(robot.port, robot.devices, robot.walkdir, hdlr, library.get(robot.walkdir), heartbeat, robot.metrics)
+
+
+
+# load the servo calibrations, before any walkfile is converted
+if s_calibdir != None:
+        log_.info('Loading calibrations from \'' + s_calibdir + '\' ...')
+        if not os.path.isdir(s_calibdir):
+                log_.err('fail: no such directory')
+        else:
+                log_.info('loaded ' + str(walkietalkie.loadCalibration(s_calibdir)) + ' calibrations')
 
-if ser.cliIsConn():
-        ser.cli.close()
-ser.ss.close()
+if s_config == None:
+        runController(port, s_devices, s_walkdir, cmd_hdlr, metrics = m_port)
+else:
+        # load every walk directory once, the robot processes share the compiled programs
+        robots = supervisor.loadConfig(s_config)
+        library = {}
+        for robot in robots:
+                if not robot.walkdir in library:
+                        fw = walkietalkie.FileWalker(None, log_)
+                        loadPrograms(fw, robot.walkdir)
+                        for prg in fw.prgs.values():
+                                prg.encode()
+                        library[robot.walkdir] = fw.prgs
+        sup = supervisor.Supervisor(robots, runRobot, log_)
+        sup.run()
@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+
+##
+# @file         metrics.py
+# @author       agent
+# @version      0.0.0-r0
+# @since        26-10-19
+#
+# @brief        Serves the counters of the controller in the Prometheus text format over http.
+#
+# The counters are owned by the control loop, which publishes a snapshot of them every
+# PUBLISH_RATE ms by replacing a single reference. The http thread only ever reads the latest
+# snapshot, so a scrape never takes a lock the motion loop could wait on.
+##
+
+#
+# IMPORTS
+#
+import threading
+import bisect
+
+try:
+        import http.server as httpserver
+except ImportError:
+        import BaseHTTPServer as httpserver
+
+#
+# PRIVATE VARIABLES and FUNCTIONS
+#
+
+##
+# Formats a number the way Prometheus expects it.
+# @param v      the number
+# @returns      the string
+def _fmt(v):
+        if v == float('inf'):
+                return '+Inf'
+        return str(v)
+
+##
+# Renders a snapshot in the text exposition format.
+# @param snapshot       a list of (name, type, help, [(labels, value)]) tuples
+# @returns              the text
+def render(snapshot):
+        lines = []
+        for (name, typ, hlp, samples) in snapshot:
+                lines.append('# HELP ' + name + ' ' + hlp)
+                lines.append('# TYPE ' + name + ' ' + typ)
+                for (labels, value) in samples:
+                        lines.append(labels + ' ' + _fmt(value))
+        return '\n'.join(lines) + '\n'
+
+#
+# CLASSES
+#
+
+##
+# A histogram with fixed upper bucket bounds.
+class Histogram:
+
+        ##
+        # @param bounds the upper bounds of the buckets, ascending
+        def __init__(self, bounds):
+                self.bounds = bounds
+                self.counts = [0]*(len(bounds) + 1)
+                self.sum = 0
+                self.count = 0
+
+        ##
+        # Adds a value.
+        # @param v      the value
+        def observe(self, v):
+                self.counts[bisect.bisect_left(self.bounds, v)] += 1
+                self.sum += v
+                self.count += 1
+
+        ##
+        # Returns the samples of the histogram for a snapshot, the buckets are cumulative.
+        # @param name   the name of the metric
+        # @returns      a list of (labels, value)
+        def samples(self, name):
+                res = []
+                acc = 0
+                for i in range(0, len(self.counts)):
+                        acc += self.counts[i]
+                        le = float('inf')
+                        if i < len(self.bounds):
+                                le = self.bounds[i]
+                        res.append((name + '_bucket{le="' + _fmt(le) + '"}', acc))
+                res.append((name + '_sum', self.sum))
+                res.append((name + '_count', self.count))
+                return res
+
+##
+# Answers GET /metrics with the latest snapshot.
+class _Handler(httpserver.BaseHTTPRequestHandler):
+
+        def do_GET(self):
+                if self.path.split('?', 1)[0] != '/metrics':
+                        self.send_error(404)
+                        return
+                data = render(self.server.metrics.snapshot).encode('UTF-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+        def log_message(self, fmt, *args):
+                pass
+
+##
+# The counters of a controller and the http listener serving them.
+class Metrics:
+
+        PUBLISH_RATE = 250
+        LATENESS_BOUNDS = [0, 1, 2, 5, 10, 20, 50, 100, 200, 500]
+
+        def __init__(self):
+                self.commands = {}
+                self.connections = 0
+                self.lateness = Histogram(Metrics.LATENESS_BOUNDS)
+                self.steps = 0
+                self.published = 0
+                self.snapshot = []
+                self.httpd = None
+
+        ##
+        # Counts a command.
+        # @param name   the name of the command
+        def command(self, name):
+                self.commands[name] = self.commands.get(name, 0) + 1
+
+        ##
+        # Counts a client connection.
+        def connected(self):
+                self.connections += 1
+
+        ##
+        # Records the lateness of the Step the FileWalker has just executed, if any.
+        # @param fw     the FileWalker, right after doTick()
+        def observe(self, fw):
+                if fw.steps != self.steps:
+                        self.steps = fw.steps
+                        self.lateness.observe(fw.lateness)
+
+        ##
+        # Publishes a new snapshot if the last one is older than PUBLISH_RATE ms.
+        # @param fw     the FileWalker or None
+        # @param conn   wheter a client is connected
+        # @param now    the current time in ms
+        def publish(self, fw, conn, now):
+                if now - self.published < Metrics.PUBLISH_RATE:
+                        return
+                self.published = now
+                snap = []
+                if fw != None:
+                        snap.append(('cairo_ticks_total', 'counter', 'Steps executed by the file walker.', [('cairo_ticks_total', fw.steps)]))
+                        snap.append(('cairo_program_switches_total', 'counter', 'Programs selected or switched to.', [('cairo_program_switches_total', fw.switches)]))
+                        if fw.motd != None:
+                                snap.append(('cairo_uart_frames_total', 'counter', 'Frames sent to the PiCs.', [('cairo_uart_frames_total', fw.motd.frames)]))
+                                snap.append(('cairo_uart_bytes_total', 'counter', 'Bytes sent to the PiCs.', [('cairo_uart_bytes_total', fw.motd.bytes)]))
+                snap.append(('cairo_step_lateness_ms', 'histogram', 'Time a Step was executed after its deadline.', self.lateness.samples('cairo_step_lateness_ms')))
+                snap.append(('cairo_commands_total', 'counter', 'Commands received by name.', [('cairo_commands_total{command="' + k.replace('\\', '\\\\').replace('"', '\\"') + '"}', v) for (k, v) in sorted(self.commands.items())]))
+                snap.append(('cairo_client_connections_total', 'counter', 'Clients accepted on the command port.', [('cairo_client_connections_total', self.connections)]))
+                snap.append(('cairo_client_connected', 'gauge', 'Wheter a client is connected.', [('cairo_client_connected', 1 if conn else 0)]))
+                self.snapshot = snap
+
+        ##
+        # Starts the http listener on its own thread.
+        # @param port   the port to listen on
+        def start(self, port):
+                self.httpd = httpserver.HTTPServer(('', port), _Handler)
+                self.httpd.metrics = self
+                th = threading.Thread(target = self.httpd.serve_forever, name = 'metrics')
+                th.daemon = True
+                th.start()
+
+        ##
+        # Stops the http listener.
+        def stop(self):
+                if self.httpd != None:
+                        self.httpd.shutdown()
+                        self.httpd.server_close()
+                        self.httpd = None
@@ -0,0 +1,243 @@
+#!/usr/bin/env python
+
+##
+# @file         retime.py
+# @author       agent
+# @version      0.0.0-r0
+# @since        26-10-19
+#
+# @brief        Shortens the delays of a 'prg' Program to what the servos can do.
+#
+# The delay of a Step is the time waited after it is sent, before the next pose goes out, so it
+# is the time the servos have to move from its pose to the next one. Every servo is assumed to
+# start and stop at rest and to move with a trapezoidal velocity profile, limited by its maximum
+# speed (deg/s) and acceleration (deg/s^2), so the minimal delay for a move of d deg is
+#
+#     2*sqrt(d/amax)          if d <= vmax^2/amax
+#     d/vmax + vmax/amax      otherwise
+#
+# and the slowest servo decides. All Steps are computed at once with numpy. The last Step of a
+# looping program has to reach the first prg Step again, the last Step of any other program
+# keeps its delay, there is no pose after it. check() replays a Program and finds the Steps
+# which are still too short.
+#
+#     python retime.py [-v vmax] [-a amax] [-m margin] [-c calibdir] in.walk out.walk
+##
+
+#
+# IMPORTS
+#
+import sys
+import numpy
+
+import logger
+import walkietalkie
+
+#
+# PRIVATE VARIABLES and FUNCTIONS
+#
+
+##
+# Converts raw values to degrees using the servo calibrations.
+# @param raw    an array of shape (n, 12)
+# @returns      the angles in deg, shape (n, 12)
+def _toDeg(raw):
+        lut = numpy.array([cal.raw_deg for cal in walkietalkie.DefaultCalibration], dtype = float)
+        raw = numpy.clip(raw, 0, walkietalkie.ServoCalibration.LUT_RAW - 1)
+        return lut[numpy.arange(lut.shape[0])[None, :], raw]
+
+##
+# Parses a limit given as single value or as comma separated value per servo.
+# @param s      the string
+# @returns      a float or an array of 12 floats
+def _parseLimit(s):
+        vals = [float(v) for v in s.split(',')]
+        if len(vals) == 1:
+                return vals[0]
+        return numpy.array(vals)
+
+#
+# FUNCTIONS
+#
+
+##
+# Computes the minimal time for moves between poses.
+# @param frm    the start poses in raw values, shape (n, 12)
+# @param to     the end poses in raw values, shape (n, 12)
+# @param vmax   the maximum speed in deg/s, a scalar or one value per servo
+# @param amax   the maximum acceleration in deg/s^2, a scalar or one value per servo
+# @returns      the times in ms, shape (n,)
+def minDelays(frm, to, vmax, amax):
+        d = numpy.abs(_toDeg(to) - _toDeg(frm))
+        vmax = numpy.broadcast_to(numpy.asarray(vmax, dtype = float), d.shape)
+        amax = numpy.broadcast_to(numpy.asarray(amax, dtype = float), d.shape)
+        t = numpy.where(d <= vmax*vmax/amax, 2.0*numpy.sqrt(d/amax), d/vmax + vmax/amax)
+        return 1000.0*t.max(axis = 1)
+
+##
+# Creates a retimed copy of a 'prg' Program, see the file description.
+# The delays are scaled by the speed of the Program, so the played times match the limits.
+# @param prg    the Program
+# @param vmax   the maximum speed in deg/s, a scalar or one value per servo
+# @param amax   the maximum acceleration in deg/s^2, a scalar or one value per servo
+# @param margin a factor applied to the minimal delays
+# @param min_delay      the smallest delay in ms, sending a Step takes time itself
+# @returns      the retimed Program and a report dict, a ValueError is raised for programs
+#               which can't be retimed and for limits which aren't positive numbers
+def retime(prg, vmax = 500.0, amax = 50000.0, margin = 1.0, min_delay = 3):
+        init = [stp for stp in prg.init_steps]
+        main = [stp for stp in prg.prg_steps]
+        steps = init + main
+        if prg.use != 'prg' or len(steps) == 0:
+                raise ValueError('only prg programs with steps can be retimed')
+        for lim in [numpy.asarray(vmax, dtype = float), numpy.asarray(amax, dtype = float)]:
+                if not numpy.all(numpy.isfinite(lim) & (lim > 0)):
+                        raise ValueError('the speed and acceleration limits must be positive numbers')
+        pos = numpy.array([list(stp.pos) for stp in steps], dtype = int)
+        old = numpy.array([stp.delay for stp in steps], dtype = float)
+
+        ni = len(init)
+        need = numpy.zeros(len(steps))
+        if len(steps) > 1:
+                need[:-1] = minDelays(pos[:-1], pos[1:], vmax, amax)
+        if prg.looping and len(main) > 0:
+                need[-1] = minDelays(pos[-1:], pos[ni:ni + 1], vmax, amax)[0]
+        new = numpy.maximum(numpy.ceil(need*margin*prg.getRate()), min_delay)
+        if not prg.looping:
+                new[-1] = old[-1]
+        new = new.astype(int)
+
+        res = walkietalkie.Program('<retime:' + prg.name + '>')
+        res.name = prg.name + '-retimed'
+        res.id = prg.id
+        res.prg_version = prg.prg_version
+        res.speed = prg.speed
+        res.looping = prg.looping
+        res.tick = prg.tick
+        res.use = 'prg'
+        for i in range(0, len(steps)):
+                stp = walkietalkie.Step()
+                stp.setStepsRaw(steps[i].pos)
+                stp.setDelayMs(int(new[i]))
+                if i < ni:
+                        res.init_steps.append(stp)
+                else:
+                        res.prg_steps.append(stp)
+        res.encode()
+
+        report = {
+                'name': prg.name,
+                'steps': len(steps),
+                'setup_ms': int(old[:ni].sum()),
+                'setup_retimed_ms': int(new[:ni].sum()),
+                'cycle_ms': int(old[ni:].sum()),
+                'cycle_retimed_ms': int(new[ni:].sum()),
+                'slower_steps': int(numpy.count_nonzero(new > old)),
+        }
+        report['speedup'] = 1.0
+        if report['cycle_retimed_ms'] > 0:
+                report['speedup'] = report['cycle_ms']/float(report['cycle_retimed_ms'])
+        report['violations'] = len(check(res, vmax, amax))
+        return res, report
+
+##
+# Plays a Program on a VirtualClock, looping programs for two cycles so the wrap is played as
+# well, and compares the time between every two sent poses with minDelays() of the move.
+# @param prg    the Program
+# @param vmax   the maximum speed in deg/s, a scalar or one value per servo
+# @param amax   the maximum acceleration in deg/s^2, a scalar or one value per servo
+# @returns      a list of (step, gap_ms, needed_ms) for every move which was too short
+def check(prg, vmax = 500.0, amax = 50000.0):
+        log = logger.Logger()
+        log.setLevel(4)
+        clock = walkietalkie.VirtualClock()
+        fw = walkietalkie.FileWalker(walkietalkie.RecordingDistributor(clock, False), log, clock)
+        fw.prgs[prg.name] = prg
+        fw.selectProgram(prg.name)
+        if prg.looping:
+                fw.repeats = 2
+        fw.setNextDiff(0)
+        fw.time = clock.now()
+        played = []
+        steps = 0
+        while True:
+                clock.jump(fw.getDeadline())
+                fw.doTick()
+                if fw.is_stop:
+                        break
+                if fw.steps != steps:
+                        steps = fw.steps
+                        played.append((clock.now(), list(fw.last_step.pos)))
+        if len(played) < 2:
+                return []
+        t = numpy.array([p[0] for p in played], dtype = float)
+        pos = numpy.array([p[1] for p in played], dtype = int)
+        need = minDelays(pos[:-1], pos[1:], vmax, amax)
+        gap = t[1:] - t[:-1]
+        # the played delays are rounded to whole ms after applying the speed
+        bad = numpy.nonzero(gap < need - 0.5)[0]
+        return [(int(i), int(gap[i]), float(need[i])) for i in bad]
+
+##
+# Formats a report of retime() as single line.
+# @param report the report
+# @returns      the string
+def formatReport(report):
+        return report['name'] + ': cycle ' + str(report['cycle_ms']) + 'ms -> ' + str(report['cycle_retimed_ms']) + 'ms (x' + ('%.2f' % report['speedup']) + '), setup ' + str(report['setup_ms']) + 'ms -> ' + str(report['setup_retimed_ms']) + 'ms, ' + str(report['slower_steps']) + ' of ' + str(report['steps']) + ' steps were faster than the servos allow, ' + str(report['violations']) + ' moves still too short'
+
+#
+# CODE
+#
+if __name__ == '__main__':
+        arg_sel = 'NONE'
+        vmax = 500.0
+        amax = 50000.0
+        margin = 1.0
+        files = []
+        for arg in sys.argv[1:]:
+                if arg_sel == 'NONE':
+                        if arg == '-v':
+                                arg_sel = 'VMAX'
+                        elif arg == '-a':
+                                arg_sel = 'AMAX'
+                        elif arg == '-m':
+                                arg_sel = 'MARGIN'
+                        elif arg == '-c':
+                                arg_sel = 'CALIBRATION'
+                        elif arg == '-h':
+                                print("retimes a prg walkfile to the speed and acceleration limits of the servos")
+                                print('usage: retime.py [options] <in.walk> <out.walk>')
+                                print('args:')
+                                print('  v ... the maximum speed in deg/s, one value or 12')
+                                print('        comma separated values')
+                                print('  a ... the maximum acceleration in deg/s^2, like -v')
+                                print('  m ... margin, the factor applied to the minimal delays')
+                                print('  c ... calibration, specify the directory containing')
+                                print('        the servo<N>.cal files')
+                                print('  h ... help, print this dialog')
+                                sys.exit(0)
+                        else:
+                                files.append(arg)
+                else:
+                        if arg_sel == 'VMAX':
+                                vmax = _parseLimit(arg)
+                        elif arg_sel == 'AMAX':
+                                amax = _parseLimit(arg)
+                        elif arg_sel == 'MARGIN':
+                                margin = float(arg)
+                        elif arg_sel == 'CALIBRATION':
+                                walkietalkie.loadCalibration(arg)
+                        arg_sel = 'NONE'
+
+        if len(files) != 2:
+                print('usage: retime.py [options] <in.walk> <out.walk>')
+                sys.exit(1)
+        prg = walkietalkie.Program(files[0])
+        prg.load()
+        try:
+                res, report = retime(prg, vmax, amax, margin)
+        except ValueError as e:
+                print(str(e))
+                sys.exit(1)
+        res.save(files[1])
+        print(formatReport(report))
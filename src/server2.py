@@ -19,8 +19,27 @@ import fcntl
 import time
 import select
 import re
+import cProfile
+import pstats
+import tracemalloc
+import io
 
 import cmd_line
+import telemetry
+import walkietalkie
+import setpoints
+import metrics
+import tracing
+
+try:
+        import gait
+except ImportError:
+        gait = None
+
+try:
+        import retime
+except ImportError:
+        retime = None
 
 ###
 # PRIVATE VARIABLES and FUNCTIONS
@@ -28,44 +47,39 @@ import cmd_line
 
 # taken from so: http://stackoverflow.com/questions/11735821/python-get-localhost-ip
 # user credit: sloth
-# def _get_interface_ip(ifname):
-#         s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-#         return socket.inet_ntoa(fcntl.ioctl(s.fileno(), 0x8915, struct.pack('256s', ifname[:15]))[20:24])
-
-
-# def _getLocalIp():
-#         ip = 'localhost'
-#         try:
-#                 ip = socket.gethostbyname(socket.gethostname())
-#         except socket.error as e:
-#                 interfaces = [
-#                         'eth0',
-#                         'eth1',
-#                         'eth2',
-#                         'wlan0',
-#                         'wlan1',
-#                         'wifi0',
-#                         'ath0',
-#                         'ath1',
-#                         'ppp0',
-#                 ]
-
-#                 for ifname in interfaces:
-#                         try:
-#                                 ip = _get_interface_ip(ifname)
-#                                 break
-#                         except IOError:
-#                                 pass
-#                 return ip
-#         else:
-#                 return ip
+def _get_interface_ip(ifname):
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+                return socket.inet_ntoa(fcntl.ioctl(s.fileno(), 0x8915, struct.pack('256s', ifname[:15].encode('UTF-8')))[20:24])
+        finally:
+                s.close()
 
+##
+# Returns the names of all local network interfaces, falling back to a list of
+# common names on systems which do not support `socket.if_nameindex`.
+def _get_interfaces():
+        try:
+                return [name for (_, name) in socket.if_nameindex()]
+        except (AttributeError, OSError):
+                return ['eth0', 'eth1', 'eth2', 'wlan0', 'wlan1', 'wifi0', 'ath0', 'ath1', 'ppp0']
+
+##
+# Determines the ip of this device from the local interface list, no network
+# access is required. The first non-loopback address wins, if there is none,
+# the hostname is resolved and as last resort 'localhost' is returned.
+# @returns      the local ip
 def _getLocalIp():
-        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        s.connect(('www.google.com', 80))
-        ret = s.getsockname()[0]
-        s.close()
-        return ret
+        for ifname in _get_interfaces():
+                try:
+                        ip = _get_interface_ip(ifname)
+                except (IOError, OSError):
+                        continue
+                if not ip.startswith('127.'):
+                        return ip
+        try:
+                return socket.gethostbyname(socket.gethostname())
+        except socket.error:
+                return 'localhost'
 
 ###
 # CLASSES
@@ -73,7 +87,15 @@ def _getLocalIp():
 class Server:
 
         CONNECTION_BUFFER_LEN = 1024
+        ##
+        # The line ending an upload.
+        UPLOAD_END = '.'
+        RECORD_TICK = 100
         BROADCAST_RATE = 1000
+        BROADCAST_RATE_MAX = 32000
+
+        DISCOVERY_PREFIX = 'main_brain_super_server'
+        DISCOVERY_QUERY = DISCOVERY_PREFIX + '?'
 
         STR_LINE_END_REGEX = '^.*(\r\n|\n\r|\r|\n)'
         REG_LINE_END_REGEX = re.compile(STR_LINE_END_REGEX)
@@ -117,6 +139,73 @@ class Server:
                                 self.server.cliSend("selected program: " + argv[0])
                                 print('selecting: ' + str(self.server.fw.selectProgram(argv[0])))
 
+        class CommandFWSwitch(cmd_line.Command):
+
+                def __init__(self, hdlr, server):
+                        cmd_line.Command.__init__(self, hdlr)
+                        self.server = server
+
+                def do(self, argv):
+                        if len(argv) == 0:
+                                self.server.cliSend("usage: fwswitch <name> [cycle|step] [blend_steps]")
+                                return
+                        at = walkietalkie.FileWalker.SWITCH_CYCLE
+                        blend = 0
+                        if len(argv) > 1:
+                                at = argv[1]
+                        if len(argv) > 2:
+                                blend = int(argv[2])
+                        if at not in [walkietalkie.FileWalker.SWITCH_CYCLE, walkietalkie.FileWalker.SWITCH_STEP]:
+                                self.server.cliSend("no such boundary: " + at)
+                                return
+                        if self.server.fw.prepareProgram(argv[0], at, blend):
+                                self.server.logger.info("switching to program: " + argv[0])
+                                self.server.cliSend("switching to program: " + argv[0])
+                        else:
+                                self.server.cliSend("no such program: " + argv[0])
+
+        class CommandQueue(cmd_line.Command):
+
+                def __init__(self, hdlr, server):
+                        cmd_line.Command.__init__(self, hdlr)
+                        self.server = server
+
+                def do(self, argv):
+                        fw = self.server.fw
+                        if len(argv) == 0 or argv[0] == 'list':
+                                if fw.select != None:
+                                        self.server.cliSend("playing: " + fw.select.name + " (" + str(fw.cycles) + "/" + str(fw.repeats) + ")")
+                                if fw.pending != None:
+                                        self.server.cliSend("pending: " + fw.pending.name)
+                                for i in range(0, len(fw.playlist)):
+                                        self.server.cliSend(str(i) + ": " + fw.playlist[i][0] + " x" + str(fw.playlist[i][1]))
+                        elif argv[0] == 'add' and len(argv) > 1:
+                                repeats = 0
+                                if len(argv) > 2:
+                                        repeats = int(argv[2])
+                                if fw.queueProgram(argv[1], repeats):
+                                        self.server.cliSend("queued: " + argv[1])
+                                else:
+                                        self.server.cliSend("no such program: " + argv[1])
+                        elif argv[0] == 'insert' and len(argv) > 2:
+                                repeats = 0
+                                if len(argv) > 3:
+                                        repeats = int(argv[3])
+                                if fw.queueProgram(argv[2], repeats, int(argv[1])):
+                                        self.server.cliSend("queued: " + argv[2])
+                                else:
+                                        self.server.cliSend("no such program: " + argv[2])
+                        elif argv[0] == 'remove' and len(argv) > 1:
+                                if fw.dequeueProgram(int(argv[1])):
+                                        self.server.cliSend("removed: " + argv[1])
+                                else:
+                                        self.server.cliSend("no such entry: " + argv[1])
+                        elif argv[0] == 'clear':
+                                fw.clearQueue()
+                                self.server.cliSend("queue cleared")
+                        else:
+                                self.server.cliSend("usage: queue [list|add <name> [repeats]|insert <index> <name> [repeats]|remove <index>|clear]")
+
         class CommandFWDeselect(cmd_line.Command):
 
                 def __init__(self, hdlr, server):
@@ -138,7 +227,11 @@ class Server:
                         ser_va = int(argv[1])
                         pic_id = ord(pic_id) - ord('A') + 1
                         ser_id = ord(ser_id) - ord('A')
-                        
+                        idx = (pic_id - 1)*4 + ser_id
+                        if ser_id < 0 or ser_id > 3 or idx < 0 or idx >= len(walkietalkie.DefaultCalibration):
+                                self.server.cliSend("no such servo")
+                                return
+
                         self.server.logger.debug(str(pic_id))
                         self.server.logger.debug(str(ser_id))
 
@@ -146,8 +239,10 @@ class Server:
                         self.server.fw.motd.setMode(0)
                         self.server.fw.motd.setPicAddr(pic_id)
                         self.server.fw.motd.setServoAddr(ser_id)
-                        self.server.fw.motd.setServoVal(36.0+(157.0-36.0)*ser_va/(191.0))
+                        self.server.fw.motd.setServoVal(walkietalkie.DefaultCalibration[idx].degToRaw(ser_va))
                         self.server.fw.motd.send()
+                        if self.server.recorder != None:
+                                self.server.recorder.setServo(idx, walkietalkie.DefaultCalibration[idx].degToRaw(ser_va), self.server.fw.clock.now())
 
         class CommandDoStep(cmd_line.Command):
 
@@ -161,6 +256,459 @@ class Server:
                         stp = self.server.fw.getNextStep()
                         if stp != None:
                                 self.server.fw.doStep(stp)
+                                if self.server.recorder != None:
+                                        self.server.recorder.addPose(stp.pos, self.server.fw.clock.now())
+
+        class CommandSubscribe(cmd_line.Command):
+
+                def __init__(self, hdlr, server):
+                        cmd_line.Command.__init__(self, hdlr)
+                        self.server = server
+
+                def do(self, argv):
+                        if len(argv) == 0:
+                                for sub in self.server.telemetry.subs.values():
+                                        self.server.cliSend(repr(sub))
+                                return
+                        if len(argv) < 2:
+                                self.server.cliSend("usage: subscribe <host> <port> [rate_ms]")
+                                return
+                        addr = (argv[0], int(argv[1]))
+                        rate = telemetry.Telemetry.DEFAULT_RATE
+                        if len(argv) > 2:
+                                rate = int(argv[2])
+                        self.server.telemetry.subscribe(addr, rate)
+                        self.server.logger.info("subscribed: " + argv[0] + ':' + argv[1])
+                        self.server.cliSend("subscribed: " + argv[0] + ':' + argv[1])
+
+        class CommandUnsubscribe(cmd_line.Command):
+
+                def __init__(self, hdlr, server):
+                        cmd_line.Command.__init__(self, hdlr)
+                        self.server = server
+
+                def do(self, argv):
+                        if len(argv) < 2:
+                                self.server.cliSend("usage: unsubscribe <host> <port>")
+                                return
+                        if self.server.telemetry.unsubscribe((argv[0], int(argv[1]))):
+                                self.server.logger.info("unsubscribed: " + argv[0] + ':' + argv[1])
+                                self.server.cliSend("unsubscribed: " + argv[0] + ':' + argv[1])
+                        else:
+                                self.server.cliSend("no such subscriber")
+
+        class CommandSpeed(cmd_line.Command):
+
+                def __init__(self, hdlr, server):
+                        cmd_line.Command.__init__(self, hdlr)
+                        self.server = server
+
+                def do(self, argv):
+                        if len(argv) == 0:
+                                self.server.cliSend("speed: " + str(self.server.fw.warp) + " (rate " + str(self.server.fw.rate) + ")")
+                        elif self.server.fw.setWarp(argv[0]):
+                                self.server.logger.info("speed: " + argv[0])
+                                self.server.cliSend("speed: " + argv[0])
+                        else:
+                                self.server.cliSend("speed must be positive")
+
+        ##
+        # Moves the selected program to a time or a Step, `seek <ms>|step <n>`.
+        class CommandSeek(cmd_line.Command):
+
+                def __init__(self, hdlr, server):
+                        cmd_line.Command.__init__(self, hdlr)
+                        self.server = server
+
+                def do(self, argv):
+                        try:
+                                if len(argv) == 1:
+                                        idx = self.server.fw.seek(int(argv[0]))
+                                elif len(argv) == 2 and argv[0] == 'step':
+                                        idx = self.server.fw.seekStep(int(argv[1]))
+                                else:
+                                        self.server.cliSend("usage: seek <ms>|step <n>")
+                                        return
+                        except ValueError:
+                                self.server.cliSend("usage: seek <ms>|step <n>")
+                                return
+                        if idx == None:
+                                self.server.cliSend("no prg program selected")
+                                return
+                        tl = self.server.fw.select.getTimeline()
+                        self.server.logger.info("seeked to step " + str(idx) + " at " + str(tl.starts[idx]) + "ms")
+                        self.server.cliSend("seeked to step " + str(idx) + " at " + str(tl.starts[idx]) + "ms")
+
+        class CommandPause(cmd_line.Command):
+
+                def __init__(self, hdlr, server):
+                        cmd_line.Command.__init__(self, hdlr)
+                        self.server = server
+
+                def do(self, argv):
+                        if self.server.fw.pause():
+                                self.server.logger.info("paused")
+                                self.server.cliSend("paused")
+                        else:
+                                self.server.cliSend("already paused")
+
+        class CommandResume(cmd_line.Command):
+
+                def __init__(self, hdlr, server):
+                        cmd_line.Command.__init__(self, hdlr)
+                        self.server = server
+
+                def do(self, argv):
+                        if self.server.fw.resume():
+                                self.server.logger.info("resumed")
+                                self.server.cliSend("resumed")
+                        else:
+                                self.server.cliSend("not paused")
+
+        class CommandHealth(cmd_line.Command):
+
+                def __init__(self, hdlr, server):
+                        cmd_line.Command.__init__(self, hdlr)
+                        self.server = server
+
+                def do(self, argv):
+                        health = self.server.fw.motd.getHealth()
+                        if len(health) == 0:
+                                self.server.cliSend("no uart read-back")
+                        for i in range(0, len(health)):
+                                self.server.cliSend(str(i) + ": " + repr(health[i]))
+                        stats = self.server.fw.motd.getWriterStats()
+                        for i in range(0, len(stats)):
+                                self.server.cliSend(str(i) + ": " + repr(stats[i]))
+
+        ##
+        # Profiles the cpu usage of the running process with cProfile.
+        # `profile start|stop|dump [file]`, dump writes the pstats file and reports the top entries.
+        class CommandProfile(cmd_line.Command):
+
+                def __init__(self, hdlr, server):
+                        cmd_line.Command.__init__(self, hdlr)
+                        self.server = server
+
+                def do(self, argv):
+                        if len(argv) == 0:
+                                self.server.cliSend("usage: profile start|stop|dump [file]")
+                        elif argv[0] == 'start':
+                                if self.server.profiler == None:
+                                        self.server.profiler = cProfile.Profile()
+                                self.server.profiler.enable()
+                                self.server.logger.info("profiling started")
+                                self.server.cliSend("profiling started")
+                        elif self.server.profiler == None:
+                                self.server.cliSend("profiling not started")
+                        elif argv[0] == 'stop':
+                                self.server.profiler.disable()
+                                self.server.logger.info("profiling stopped")
+                                self.server.cliSend("profiling stopped")
+                        elif argv[0] == 'dump':
+                                path = 'mc-' + time.strftime('%Y%m%d-%H%M%S') + '.pstats'
+                                if len(argv) > 1:
+                                        path = argv[1]
+                                self.server.profiler.disable()
+                                try:
+                                        self.server.profiler.dump_stats(path)
+                                except (IOError, OSError) as e:
+                                        # the profiler is kept stopped, so the dump can be retried
+                                        self.server.cliSend("profile: " + str(e))
+                                        return
+                                out = io.StringIO()
+                                pstats.Stats(self.server.profiler, stream = out).sort_stats('cumulative').print_stats(10)
+                                self.server.profiler = None
+                                for line in out.getvalue().split('\n'):
+                                        if len(line.strip()) > 0:
+                                                self.server.cliSend(line)
+                                self.server.logger.info("profile written to: " + path)
+                                self.server.cliSend("profile written to: " + path)
+
+        ##
+        # Traces the memory allocations of the running process with tracemalloc.
+        # `memprof start [frames]|snapshot [file]|diff|stop`, diff compares the last two snapshots.
+        class CommandMemprof(cmd_line.Command):
+
+                def __init__(self, hdlr, server):
+                        cmd_line.Command.__init__(self, hdlr)
+                        self.server = server
+
+                def do(self, argv):
+                        if len(argv) == 0:
+                                self.server.cliSend("usage: memprof start [frames]|snapshot [file]|diff|stop")
+                        elif argv[0] == 'start':
+                                frames = 1
+                                try:
+                                        if len(argv) > 1:
+                                                frames = int(argv[1])
+                                        tracemalloc.start(frames)
+                                except ValueError:
+                                        self.server.cliSend("usage: memprof start [frames]|snapshot [file]|diff|stop")
+                                        return
+                                self.server.logger.info("memory tracing started")
+                                self.server.cliSend("memory tracing started")
+                        elif not tracemalloc.is_tracing():
+                                self.server.cliSend("memory tracing not started")
+                        elif argv[0] == 'snapshot':
+                                snap = tracemalloc.take_snapshot()
+                                self.server.snapshots = self.server.snapshots[-1:] + [snap]
+                                path = 'mc-' + time.strftime('%Y%m%d-%H%M%S') + '.snapshot'
+                                if len(argv) > 1:
+                                        path = argv[1]
+                                try:
+                                        snap.dump(path)
+                                except (IOError, OSError) as e:
+                                        self.server.cliSend("memprof: " + str(e))
+                                        return
+                                for stat in snap.statistics('lineno')[:10]:
+                                        self.server.cliSend(str(stat))
+                                self.server.logger.info("snapshot written to: " + path)
+                                self.server.cliSend("snapshot written to: " + path)
+                        elif argv[0] == 'diff':
+                                if len(self.server.snapshots) < 2:
+                                        self.server.cliSend("need two snapshots")
+                                        return
+                                for stat in self.server.snapshots[1].compare_to(self.server.snapshots[0], 'lineno')[:10]:
+                                        self.server.cliSend(str(stat))
+                        elif argv[0] == 'stop':
+                                tracemalloc.stop()
+                                self.server.snapshots = []
+                                self.server.logger.info("memory tracing stopped")
+                                self.server.cliSend("memory tracing stopped")
+
+        ##
+        # Streams the shared setpoint table to the servos.
+        # `shm start [name] [rate_ms]` creates the block and stops the filewalker, `shm stop` removes it.
+        class CommandShm(cmd_line.Command):
+
+                def __init__(self, hdlr, server):
+                        cmd_line.Command.__init__(self, hdlr)
+                        self.server = server
+
+                def do(self, argv):
+                        if len(argv) == 0:
+                                self.server.cliSend("usage: shm start [name] [rate_ms]|stop")
+                        elif argv[0] == 'start':
+                                if self.server.shm != None:
+                                        self.server.cliSend("shared setpoints already started")
+                                        return
+                                name = setpoints.SetpointTable.DEFAULT_NAME
+                                if len(argv) > 1:
+                                        name = argv[1]
+                                if len(argv) > 2:
+                                        self.server.shm_rate = int(argv[2])
+                                try:
+                                        self.server.shm = setpoints.SetpointTable(name, True)
+                                except (RuntimeError, OSError) as e:
+                                        self.server.logger.err("shared setpoints: " + str(e))
+                                        self.server.cliSend("shared setpoints: " + str(e))
+                                        return
+                                self.server.shm_seq = self.server.shm.getSeq()
+                                self.hndlr.doCmd('fwstop')
+                                self.server.logger.info("streaming shared setpoints: " + name)
+                                self.server.cliSend("streaming shared setpoints: " + name)
+                        elif argv[0] == 'stop':
+                                if self.server.shm != None:
+                                        self.server.shm.close()
+                                        self.server.shm = None
+                                self.server.logger.info("stopped shared setpoints")
+                                self.server.cliSend("stopped shared setpoints")
+
+        ##
+        # Records manual servo commands and steps into a new program.
+        # `record start <name>` starts, `record stop [thin_ms] [file]` registers the program and
+        # optionally thins it and writes it as walkfile.
+        class CommandRecord(cmd_line.Command):
+
+                def __init__(self, hdlr, server):
+                        cmd_line.Command.__init__(self, hdlr)
+                        self.server = server
+
+                def do(self, argv):
+                        if len(argv) == 2 and argv[0] == 'start':
+                                self.server.recorder = walkietalkie.Recorder(argv[1], self.server.fw.last_step, self.server.fw.clock.now())
+                                self.server.logger.info("recording: " + argv[1])
+                                self.server.cliSend("recording: " + argv[1])
+                        elif len(argv) > 0 and argv[0] == 'stop':
+                                rec = self.server.recorder
+                                if rec == None:
+                                        self.server.cliSend("not recording")
+                                        return
+                                thin = None
+                                try:
+                                        if len(argv) > 1:
+                                                thin = int(argv[1])
+                                except ValueError:
+                                        self.server.cliSend("usage: record start <name>|stop [thin_ms] [file]")
+                                        return
+                                self.server.recorder = None
+                                prg = rec.toProgram(Server.RECORD_TICK, thin, self.server.fw.clock.now())
+                                self.server.fw.prgs[prg.name] = prg
+                                self.server.logger.info("recorded program: " + prg.name + " (" + str(len(prg.prg_steps)) + " steps)")
+                                self.server.cliSend("recorded program: " + prg.name + " (" + str(len(prg.prg_steps)) + " steps)")
+                                if len(argv) > 2:
+                                        try:
+                                                prg.save(argv[2])
+                                        except IOError as e:
+                                                self.server.cliSend("record: " + str(e))
+                                                return
+                                        self.server.cliSend("written to: " + argv[2])
+                        else:
+                                self.server.cliSend("usage: record start <name>|stop [thin_ms] [file]")
+
+        ##
+        # Generates a program from a gait template and switches to it at the end of the cycle.
+        # `gait <type> [key=value]...` generates, `gait stats` reports the cache and `gait` lists
+        # the templates and their defaults.
+        class CommandGait(cmd_line.Command):
+
+                def __init__(self, hdlr, server):
+                        cmd_line.Command.__init__(self, hdlr)
+                        self.server = server
+
+                def do(self, argv):
+                        if self.server.gaits == None:
+                                self.server.cliSend("gait generator not available (numpy missing)")
+                                return
+                        if len(argv) == 0:
+                                for (kind, tmpl) in sorted(gait.TEMPLATES.items()):
+                                        self.server.cliSend(kind + ' ' + ' '.join([k + '=' + str(v) for (k, v) in sorted(tmpl[1].items())]))
+                                return
+                        if argv[0] == 'stats':
+                                self.server.cliSend(repr(self.server.gaits))
+                                return
+                        params = {}
+                        for arg in argv[1:]:
+                                if not '=' in arg:
+                                        self.server.cliSend("usage: gait <type> [key=value]...|stats")
+                                        return
+                                k, v = arg.split('=', 1)
+                                params[k] = v
+                        try:
+                                prg = self.server.gaits.get(argv[0], params)
+                        except ValueError as e:
+                                self.server.cliSend("gait: " + str(e))
+                                return
+                        fw = self.server.fw
+                        fw.prgs[prg.name] = prg
+                        fw.prepareProgram(prg.name, walkietalkie.FileWalker.SWITCH_CYCLE)
+                        keep = [name for (name, _) in fw.playlist]
+                        keep += [prg.name for prg in [fw.select, fw.pending] if prg != None]
+                        self.server.gaits.prune(fw.prgs, keep)
+                        self.server.logger.info("switching to gait: " + prg.name)
+                        self.server.cliSend("switching to gait: " + prg.name)
+
+        ##
+        # Receives a walkfile over the connection, `upload <name> [steps]`. The following lines are
+        # parsed as they arrive, up to a line holding only UPLOAD_END. The program is registered as
+        # <name> once the upload has ended or, if steps is given, as soon as its setup section and
+        # that many prg Steps are loaded. It is played right away then and waits for Steps which
+        # haven't arrived yet.
+        class CommandUpload(cmd_line.Command):
+
+                def __init__(self, hdlr, server):
+                        cmd_line.Command.__init__(self, hdlr)
+                        self.server = server
+
+                def do(self, argv):
+                        if len(argv) == 0 or len(argv) > 2:
+                                self.server.cliSend("usage: upload <name> [steps]")
+                                return
+                        if self.server.cli == None:
+                                self.server.logger.warn("upload needs a connection")
+                                return
+                        early = None
+                        if len(argv) > 1:
+                                early = int(argv[1])
+                        self.server.uploadStart(argv[0], early)
+
+        ##
+        # Traces commands and Steps down to the uart, see tracing.Tracer.
+        # `trace start|stop|clear|dump <file>`, dump writes Chrome trace-event JSON.
+        class CommandTrace(cmd_line.Command):
+
+                def __init__(self, hdlr, server):
+                        cmd_line.Command.__init__(self, hdlr)
+                        self.server = server
+
+                def do(self, argv):
+                        tr = tracing.DefaultTracer
+                        if len(argv) == 1 and argv[0] == 'start':
+                                tr.start()
+                                self.server.logger.info("tracing started")
+                                self.server.cliSend("tracing started")
+                        elif len(argv) == 1 and argv[0] == 'stop':
+                                tr.stop()
+                                self.server.logger.info("tracing stopped: " + repr(tr))
+                                self.server.cliSend("tracing stopped: " + repr(tr))
+                        elif len(argv) == 1 and argv[0] == 'clear':
+                                tr.clear()
+                                self.server.cliSend("trace cleared")
+                        elif len(argv) == 2 and argv[0] == 'dump':
+                                try:
+                                        n = tr.dump(argv[1])
+                                except IOError as e:
+                                        self.server.cliSend("trace: " + str(e))
+                                        return
+                                self.server.logger.info("trace written to: " + argv[1] + " (" + str(n) + " spans)")
+                                self.server.cliSend("trace written to: " + argv[1] + " (" + str(n) + " spans)")
+                        else:
+                                self.server.cliSend("usage: trace start|stop|clear|dump <file>")
+
+        ##
+        # Retimes a 'prg' program to the limits of the servos and registers it as <name>-retimed,
+        # `retime <name> [vmax_deg_s] [amax_deg_s2]`, see retime.retime().
+        class CommandRetime(cmd_line.Command):
+
+                def __init__(self, hdlr, server):
+                        cmd_line.Command.__init__(self, hdlr)
+                        self.server = server
+
+                def do(self, argv):
+                        if retime == None:
+                                self.server.cliSend("retiming not available (numpy missing)")
+                                return
+                        if len(argv) == 0 or len(argv) > 3:
+                                self.server.cliSend("usage: retime <name> [vmax_deg_s] [amax_deg_s2]")
+                                return
+                        if not argv[0] in self.server.fw.prgs:
+                                self.server.cliSend("no such program: " + argv[0])
+                                return
+                        vmax = 500.0
+                        amax = 50000.0
+                        try:
+                                if len(argv) > 1:
+                                        vmax = float(argv[1])
+                                if len(argv) > 2:
+                                        amax = float(argv[2])
+                                prg, report = retime.retime(self.server.fw.prgs[argv[0]], vmax, amax)
+                        except ValueError as e:
+                                self.server.cliSend("retime: " + str(e))
+                                return
+                        self.server.fw.prgs[prg.name] = prg
+                        self.server.logger.info("retimed " + retime.formatReport(report))
+                        self.server.cliSend("retimed " + retime.formatReport(report))
+
+        ##
+        # Writes the records the logger keeps in memory to a file, `logdump [file]`.
+        class CommandLogdump(cmd_line.Command):
+
+                def __init__(self, hdlr, server):
+                        cmd_line.Command.__init__(self, hdlr)
+                        self.server = server
+
+                def do(self, argv):
+                        path = None
+                        if len(argv) > 0:
+                                path = argv[0]
+                        try:
+                                path = self.server.logger.dump(path)
+                        except IOError as e:
+                                self.server.cliSend("logdump: " + str(e))
+                                return
+                        self.server.logger.info("log written to: " + path)
+                        self.server.cliSend("log written to: " + path)
 
         class CommandStop(cmd_line.Command):
 
@@ -193,22 +741,90 @@ class Server:
                 self.cmd_hdlr.regCmd('fwstop', Server.CommandFWStop(self.cmd_hdlr, self))
                 self.cmd_hdlr.regCmd('fwselect', Server.CommandFWSelect(self.cmd_hdlr, self))
                 self.cmd_hdlr.regCmd('fwdeselect', Server.CommandFWDeselect(self.cmd_hdlr, self))
+                self.cmd_hdlr.regCmd('fwswitch', Server.CommandFWSwitch(self.cmd_hdlr, self))
+                self.cmd_hdlr.regCmd('queue', Server.CommandQueue(self.cmd_hdlr, self))
                 self.cmd_hdlr.regCmd('servo', Server.CommandSetServo(self.cmd_hdlr, self))
                 self.cmd_hdlr.regCmd('dostep', Server.CommandDoStep(self.cmd_hdlr, self))
+                self.cmd_hdlr.regCmd('subscribe', Server.CommandSubscribe(self.cmd_hdlr, self))
+                self.cmd_hdlr.regCmd('unsubscribe', Server.CommandUnsubscribe(self.cmd_hdlr, self))
+                self.cmd_hdlr.regCmd('health', Server.CommandHealth(self.cmd_hdlr, self))
+                self.cmd_hdlr.regCmd('speed', Server.CommandSpeed(self.cmd_hdlr, self))
+                self.cmd_hdlr.regCmd('seek', Server.CommandSeek(self.cmd_hdlr, self))
+                self.cmd_hdlr.regCmd('pause', Server.CommandPause(self.cmd_hdlr, self))
+                self.cmd_hdlr.regCmd('resume', Server.CommandResume(self.cmd_hdlr, self))
+                self.cmd_hdlr.regCmd('profile', Server.CommandProfile(self.cmd_hdlr, self))
+                self.cmd_hdlr.regCmd('memprof', Server.CommandMemprof(self.cmd_hdlr, self))
+                self.cmd_hdlr.regCmd('shm', Server.CommandShm(self.cmd_hdlr, self))
+                self.cmd_hdlr.regCmd('record', Server.CommandRecord(self.cmd_hdlr, self))
+                self.cmd_hdlr.regCmd('gait', Server.CommandGait(self.cmd_hdlr, self))
+                self.cmd_hdlr.regCmd('logdump', Server.CommandLogdump(self.cmd_hdlr, self))
+                self.cmd_hdlr.regCmd('upload', Server.CommandUpload(self.cmd_hdlr, self))
+                self.cmd_hdlr.regCmd('trace', Server.CommandTrace(self.cmd_hdlr, self))
+                self.cmd_hdlr.regCmd('retime', Server.CommandRetime(self.cmd_hdlr, self))
                 self.cmd_hdlr.overrideCmd('exit', Server.CommandStop(self.cmd_hdlr, self))
 
                 self.bc_dest = '<broadcast>'
                 self.bc_port = 11112
                 self.bc = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
                 self.bc.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+                self.bc.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+                self.bc.setblocking(False)
+
+                # answer discovery probes on the broadcast port
+                self.query = True
+                try:
+                        self.bc.bind(('', self.bc_port))
+                except socket.error as e:
+                        self.logger.warn('discovery queries disabled: ' + str(e))
+                        self.query = False
 
                 self.last_time = int(time.time() * 1000)
                 self.broadcast = True
+                self.bc_rate = Server.BROADCAST_RATE
 
                 self.rec_data = ''
 
+                self.telemetry = telemetry.Telemetry(logger)
+
+                # profiling, both are off unless started by a command
+                self.profiler = None
+                self.snapshots = []
+
+                # shared setpoint table, streamed every shm_rate ms if started
+                self.shm = None
+                self.shm_rate = 20
+                self.shm_seq = 0
+                self.shm_time = 0
+                self.shm_step = walkietalkie.Step()
+
+                self.recorder = None
+
+                # the program being uploaded, see uploadStart()
+                self.upload = None
+                self.upload_name = None
+                self.upload_early = None
+                self.upload_lines = 0
+                self.upload_reg = False
+
+                # the metrics listener, off unless started
+                self.metrics = None
+
+                # generated gait programs, the most recent ones are cached
+                self.gaits = None
+                if gait != None:
+                        self.gaits = gait.GaitCache()
+
+        ##
+        # Starts serving the metrics over http, see metrics.Metrics.
+        # @param port   the port of the listener
+        def startMetrics(self, port):
+                self.metrics = metrics.Metrics()
+                self.metrics.start(port)
+                self.logger.info('serving metrics on port ' + str(port))
+
         def setFilewalker(self, fw):
                 self.fw = fw
+                self.telemetry.setFilewalker(fw)
 
         def cliIsConn(self):
                 return self.cli != None
@@ -226,6 +842,8 @@ class Server:
                         return
                 else:
                         self.logger.info('connection from ' + repr(self.cli));
+                        if self.metrics != None:
+                                self.metrics.connected()
 
 
         def cliRead(self):
@@ -233,8 +851,9 @@ class Server:
                         return None
 
                 if select.select([self.cli], [], [], 0.01)[0]:
+                        t0 = tracing.DefaultTracer.stamp()
                         try:
-                                data = self.cli.recv(64)
+                                data = self.cli.recv(Server.CONNECTION_BUFFER_LEN)
                         except socket.error as e:
                                 if e.errno == 32: # broken pip, cli dis
                                         self.logger.info('disconnected: ' + repr(self.cli))
@@ -248,6 +867,9 @@ class Server:
                                         self.cmd_hdlr.doCmd('fwstop', [])
                                         return None
                                 self.rec_data += data.decode('UTF-8')
+                                if t0 != None:
+                                        tracing.DefaultTracer.begin()
+                                        tracing.DefaultTracer.add('cliRead', t0, args = {'bytes': len(data)})
                                 self.logger.debug('received data: ' + repr(data))
                                 self.logger.debug('total data in q: ' + repr(self.rec_data))
 
@@ -274,40 +896,170 @@ class Server:
 
 
         def localPrompt(self):
+                if self.cmd_hdlr.inf == None:
+                        return
                 if select.select([self.cmd_hdlr.inf], [], [], 0.0)[0]:
                         line = self.cmd_hdlr.inf.readline()
                         if not line:
                                 return
+                        tr = tracing.DefaultTracer
+                        if tr.enabled:
+                                tr.begin()
+                        t0 = tr.stamp()
                         cmd = cmd_line._arg_split(line.strip())
+                        tr.add('parse', t0)
                         self.cliSend(str(cmd[:]))
                         self.logger.debug('command: ' + repr(cmd))
+                        if self.metrics != None:
+                                self.metrics.command(cmd[0])
+                        t0 = tr.stamp()
                         self.cmd_hdlr.doCmd(cmd[0], cmd[1:])
+                        tr.add('dispatch', t0, args = {'cmd': cmd[0]})
 
         def remotePrompt(self):
                 self.cliRead()
+                if self.upload != None:
+                        self.uploadRecv()
+                        return
                 cmd = self.cliGetMsg()
                 if cmd == None:
                         return
+                tr = tracing.DefaultTracer
+                t0 = tr.stamp()
                 cmd = cmd_line._arg_split(cmd.strip())
+                tr.add('parse', t0)
                 self.cliSend(str(cmd[:]))
                 self.logger.debug('command: ' + repr(cmd))
+                if self.metrics != None:
+                        self.metrics.command(cmd[0])
+                t0 = tr.stamp()
                 self.cmd_hdlr.doCmd(cmd[0], cmd[1:])
+                tr.add('dispatch', t0, args = {'cmd': cmd[0]})
+
+
+        ##
+        # Starts receiving a program, the lines received next are parsed by uploadRecv().
+        # @param name   the name to register the program as
+        # @param early  the number of prg Steps after which the program is played, None to wait for the end
+        def uploadStart(self, name, early):
+                self.upload = walkietalkie.Program('<upload:' + name + '>')
+                self.upload.begin()
+                self.upload_name = name
+                self.upload_early = early
+                self.upload_lines = 0
+                self.upload_reg = False
+                self.logger.info('receiving program: ' + name)
+                self.cliSend('send the program, end with a line holding only ' + Server.UPLOAD_END)
+
+        ##
+        # Parses all complete lines received for the upload.
+        def uploadRecv(self):
+                if self.cli == None:
+                        self.uploadEnd(False)
+                        return
+                while self.upload != None:
+                        line = self.cliGetMsg()
+                        if line == None:
+                                return
+                        if line.strip() == Server.UPLOAD_END:
+                                self.uploadEnd(True)
+                                return
+                        self.upload.feed(line)
+                        self.upload_lines += 1
+                        if self.upload_early != None and not self.upload_reg and self.upload.use == 'prg' and self.upload.isPlayable(self.upload_early):
+                                self._uploadRegister()
+                                self.fw.prepareProgram(self.upload_name, walkietalkie.FileWalker.SWITCH_CYCLE)
+                                self.logger.info('playing program while receiving: ' + self.upload_name)
+                                self.cliSend('playing program while receiving: ' + self.upload_name)
+
+        def _uploadRegister(self):
+                self.upload.name = self.upload_name
+                self.fw.prgs[self.upload_name] = self.upload
+                self.upload_reg = True
+
+        ##
+        # Ends the upload and registers the program, if it wasn't already.
+        # An aborted upload is dropped, even if it was already registered and playing.
+        # @param ok     False if the upload was aborted
+        def uploadEnd(self, ok):
+                prg = self.upload
+                self.upload = None
+                if not ok:
+                        # a truncated program must not keep playing
+                        if self.upload_reg:
+                                self.fw.removeProgram(self.upload_name)
+                        self.logger.warn('upload of ' + self.upload_name + ' aborted after ' + str(self.upload_lines) + ' lines')
+                        return
+                prg.finish()
+                if not self.upload_reg:
+                        if not prg.validate():
+                                self.logger.warn('uploaded program is invalid: ' + self.upload_name)
+                                self.cliSend('uploaded program is invalid: ' + self.upload_name)
+                                return
+                        self._uploadRegister()
+                prg.encode()
+                self.logger.info('uploaded program: ' + self.upload_name + ' (' + str(self.upload_lines) + ' lines)')
+                self.cliSend('uploaded program: ' + self.upload_name + ' (' + str(self.upload_lines) + ' lines)')
+
+        ##
+        # Sends the announcement `main_brain_super_server>port<` to addr.
+        # @param addr   the (host, port) tuple to send to
+        def announce(self, addr):
+                try:
+                        self.bc.sendto((Server.DISCOVERY_PREFIX + '>' + self.my_port + '<').encode('UTF-8'), addr)
+                except socket.error as e:
+                        print(e)
 
+        ##
+        # Answers all pending discovery probes (`main_brain_super_server?`) directly to their sender.
+        # Our own announcements are received on the same port too and are ignored.
+        def discoveryRespond(self):
+                if not self.query:
+                        return
+                while True:
+                        try:
+                                (data, addr) = self.bc.recvfrom(Server.CONNECTION_BUFFER_LEN)
+                        except socket.error:
+                                return
+                        if data.decode('UTF-8', 'replace').strip() == Server.DISCOVERY_QUERY:
+                                self.logger.debug('discovery probe from ' + repr(addr))
+                                self.announce(addr)
 
         def do(self):
-                # broadcast ip and port to other devices every BRODCAST_RATE ms
+                # broadcast ip and port to other devices, starting every BRODCAST_RATE ms
+                # and backing off exponentially up to BROADCAST_RATE_MAX ms
                 curr_time = int(1000 * time.time())
-                if self.broadcast and curr_time - self.last_time >= Server.BROADCAST_RATE and not self.cliIsConn():
-                        try:
-                                self.bc.sendto(('main_brain_super_server>' + self.my_port + '<').encode('UTF-8'), (self.bc_dest, self.bc_port))
-                        except socket.error as e:
-                                print(e)
+                if self.cliIsConn():
+                        self.bc_rate = Server.BROADCAST_RATE
+                elif self.broadcast and curr_time - self.last_time >= self.bc_rate:
+                        self.announce((self.bc_dest, self.bc_port))
                         self.last_time = curr_time
+                        self.bc_rate = min(2 * self.bc_rate, Server.BROADCAST_RATE_MAX)
+                self.discoveryRespond()
                 self.cliAccept()
                 self.localPrompt()
                 self.remotePrompt()
                 if self.fw != None and self.fw_run:
                         self.fw.doTick()
+                        if self.metrics != None:
+                                self.metrics.observe(self.fw)
+                if self.metrics != None:
+                        self.metrics.publish(self.fw, self.cliIsConn(), curr_time)
+                if self.shm != None and curr_time - self.shm_time >= self.shm_rate:
+                        self.shmStream()
+                        self.shm_time = curr_time
+                self.telemetry.do()
+
+        ##
+        # Sends the shared setpoints to the servos if they changed since the last time.
+        def shmStream(self):
+                res = self.shm.read()
+                if res == None or res[0] == self.shm_seq:
+                        return
+                self.shm_seq = res[0]
+                self.shm_step.setStepsRaw(res[1])
+                if self.fw != None:
+                        self.fw.doStep(self.shm_step)
 
 
 
@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+
+##
+# @file         setpoints.py
+# @author       agent
+# @version      0.0.0-r0
+# @since        26-10-19
+#
+# @brief        A table of servo setpoints in shared memory, for producers running in other processes.
+#
+# The block holds a sequence counter followed by the raw values of all 12 servos.
+# There is one writer (the producer) and any number of readers, synchronisation is done with a
+# sequence lock: the writer makes the counter odd while writing and even again afterwards, a reader
+# retries if the counter was odd or changed while it was reading. Nobody ever waits on a lock.
+##
+
+#
+# IMPORTS
+#
+import struct
+
+try:
+        from multiprocessing import shared_memory
+except ImportError:
+        shared_memory = None
+
+#
+# PRIVATE VARIABLES and FUNCTIONS
+#
+_FMT_SEQ = '<I'
+_FMT_VALS = '<12H'
+_OFF_VALS = struct.calcsize(_FMT_SEQ)
+
+#
+# CLASSES
+#
+
+##
+# The shared setpoint table. Requires multiprocessing.shared_memory (python 3.8).
+class SetpointTable:
+
+        SERVOS = 12
+        SIZE = _OFF_VALS + struct.calcsize(_FMT_VALS)
+        DEFAULT_NAME = 'cairo_setpoints'
+        READ_RETRIES = 16
+
+        ##
+        # Attaches to or creates the named block.
+        # @param name   the name of the shared memory block
+        # @param create wheter the block is created, only the owner should do so
+        def __init__(self, name = DEFAULT_NAME, create = False):
+                if shared_memory == None:
+                        raise RuntimeError('shared memory is not supported by this python')
+                self.name = name
+                self.owner = create
+                self.shm = shared_memory.SharedMemory(name = name, create = create, size = SetpointTable.SIZE)
+                self.buf = self.shm.buf
+                if create:
+                        struct.pack_into(_FMT_SEQ, self.buf, 0, 0)
+                        struct.pack_into(_FMT_VALS, self.buf, _OFF_VALS, *((0,)*SetpointTable.SERVOS))
+
+        ##
+        # Writes the raw values of all servos, there must only be one writer.
+        # @param vals   the 12 raw values
+        def write(self, vals):
+                seq = struct.unpack_from(_FMT_SEQ, self.buf, 0)[0]
+                struct.pack_into(_FMT_SEQ, self.buf, 0, (seq + 1) & 0xffffffff)
+                struct.pack_into(_FMT_VALS, self.buf, _OFF_VALS, *vals)
+                struct.pack_into(_FMT_SEQ, self.buf, 0, (seq + 2) & 0xffffffff)
+
+        ##
+        # Returns the sequence counter, it changes with every write.
+        # @returns      the counter
+        def getSeq(self):
+                return struct.unpack_from(_FMT_SEQ, self.buf, 0)[0]
+
+        ##
+        # Reads a consistent copy of the table.
+        # @returns      (seq, values) or None if the writer was busy on every try
+        def read(self):
+                for _ in range(0, SetpointTable.READ_RETRIES):
+                        s0 = struct.unpack_from(_FMT_SEQ, self.buf, 0)[0]
+                        if s0 & 1:
+                                continue
+                        vals = struct.unpack_from(_FMT_VALS, self.buf, _OFF_VALS)
+                        if struct.unpack_from(_FMT_SEQ, self.buf, 0)[0] == s0:
+                                return (s0, vals)
+                return None
+
+        ##
+        # Detaches from the block, the owner also removes it.
+        def close(self):
+                self.buf = None
+                self.shm.close()
+                if self.owner:
+                        self.shm.unlink()
@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+
+##
+# @file         simulate.py
+# @author       agent
+# @version      0.0.0-r0
+# @since        26-10-19
+#
+# @brief        Runs every walkfile of a directory offline and reports what it would do to the servos.
+#
+# Every program is loaded with FileWalker.loadProgram() and played on a VirtualClock against a
+# RecordingDistributor, the programs are spread over a pool of processes. Looping programs play -n
+# cycles, for 'mot' programs a cycle is the period of their MotorFunctions, and no program runs
+# longer than -l ms. The report holds per file:
+# the total duration, the cycle time, the largest change of a servo between two Steps, the number
+# of values outside of the raw servo range and the number of frames sent.
+#
+#     python simulate.py -w ./walkfiles/ -o report.json
+##
+
+#
+# IMPORTS
+#
+import multiprocessing
+import json
+import csv
+import sys
+import os
+
+import logger
+import walkietalkie
+
+#
+# PRIVATE VARIABLES and FUNCTIONS
+#
+_FIELDS = ['file', 'name', 'use', 'looping', 'setup_steps', 'prg_steps', 'steps', 'duration', 'cycle', 'max_delta', 'max_delta_servo', 'out_of_range', 'frames', 'error']
+
+##
+# Plays a single walkfile, see the file description.
+# @param job    a (path, cycles, limit) tuple
+# @returns      a dict with the fields of the report
+def simulateFile(job):
+        path, cycles, limit = job
+        res = dict([(k, None) for k in _FIELDS])
+        res['file'] = path
+        log = logger.Logger()
+        log.setLevel(4)
+        clock = walkietalkie.VirtualClock()
+        motd = walkietalkie.RecordingDistributor(clock, False)
+        fw = walkietalkie.FileWalker(motd, log, clock)
+        try:
+                if not fw.loadProgram(path):
+                        res['error'] = 'invalid program'
+                        return res
+        except Exception as e:
+                res['error'] = 'load failed: ' + str(e)
+                return res
+        prg = list(fw.prgs.values())[0]
+        res['name'] = prg.name
+        res['use'] = prg.use
+        res['looping'] = prg.looping
+        res['setup_steps'] = len(prg.init_steps)
+        res['prg_steps'] = len(prg.prg_steps)
+        if prg.use == 'prg':
+                res['cycle'] = int(round(sum([stp.delay for stp in prg.prg_steps]) / prg.getRate()))
+        else:
+                period = max([fc.end - fc.starts[0] + 1 for fc in prg.mot_fcs if len(fc.starts) > 0] + [0])
+                res['cycle'] = int(round(period / prg.getRate()))
+
+        fw.selectProgram(prg.name)
+        if prg.looping and prg.use == 'prg':
+                fw.repeats = cycles
+        # motor functions have no cycles the FileWalker counts, they are bound by their period
+        mot_limit = 0
+        if prg.looping and prg.use == 'mot':
+                mot_limit = max(res['cycle'], 1)*cycles
+        fw.setNextDiff(0)
+        fw.time = clock.now()
+        start = clock.now()
+        prev = None
+        max_delta = 0
+        max_servo = None
+        out = 0
+        steps = 0
+        while True:
+                clock.jump(fw.getDeadline())
+                fw.doTick()
+                if fw.is_stop:
+                        break
+                if fw.steps != steps:
+                        steps = fw.steps
+                        pos = fw.last_step.pos
+                        for i in range(0, len(pos)):
+                                if pos[i] < walkietalkie.ServoCalibration.RAW_MIN or pos[i] > walkietalkie.ServoCalibration.RAW_MAX:
+                                        out += 1
+                                if prev != None and abs(pos[i] - prev[i]) > max_delta:
+                                        max_delta = abs(pos[i] - prev[i])
+                                        max_servo = i
+                        prev = list(pos)
+                if limit > 0 and clock.now() - start >= limit:
+                        break
+                if mot_limit > 0 and clock.now() - start >= mot_limit:
+                        break
+        res['steps'] = steps
+        res['duration'] = clock.now() - start
+        res['max_delta'] = max_delta
+        res['max_delta_servo'] = max_servo
+        res['out_of_range'] = out
+        res['frames'] = motd.frames
+        return res
+
+##
+# Writes the report, as CSV if the path ends with .csv, otherwise as JSON.
+# @param results        the list of result dicts
+# @param path           the file, - for stdout
+def writeReport(results, path):
+        f = sys.stdout
+        if path != '-':
+                f = open(path, 'w')
+        try:
+                if path.endswith('.csv'):
+                        w = csv.DictWriter(f, _FIELDS)
+                        w.writeheader()
+                        for res in results:
+                                w.writerow(res)
+                else:
+                        json.dump(results, f, indent = 2, sort_keys = True)
+                        f.write('\n')
+        finally:
+                if f != sys.stdout:
+                        f.close()
+
+#
+# CODE
+#
+if __name__ == '__main__':
+        arg_sel = 'NONE'
+
+        s_walkdir = './walkfiles/'
+        s_calibdir = None
+        s_report = 'simulation.json'
+        jobs = multiprocessing.cpu_count()
+        cycles = 1
+        limit = 60000
+
+        for arg in sys.argv[1:]:
+                if arg_sel == 'NONE':
+                        if arg == '-w':
+                                arg_sel = 'WALKFILES'
+                        elif arg == '-c':
+                                arg_sel = 'CALIBRATION'
+                        elif arg == '-o':
+                                arg_sel = 'REPORT'
+                        elif arg == '-j':
+                                arg_sel = 'JOBS'
+                        elif arg == '-n':
+                                arg_sel = 'CYCLES'
+                        elif arg == '-l':
+                                arg_sel = 'LIMIT'
+                        elif arg == '-h':
+                                print("simulates every walkfile of a directory and reports the results")
+                                print('args:')
+                                print('  w ... specify the directory to be searched for')
+                                print('        walkfiles')
+                                print('  c ... calibration, specify the directory containing')
+                                print('        the servo<N>.cal files')
+                                print('  o ... output, the report file, .csv for csv, otherwise')
+                                print('        json, - for stdout, simulation.json by default')
+                                print('  j ... jobs, the number of processes')
+                                print('  n ... the number of cycles looping programs play, for mot')
+                                print('        programs the period of their motor functions')
+                                print('  l ... limit, the maximum simulated time per program in ms,')
+                                print('        0 for none')
+                                print('  h ... help, print this dialog')
+                                sys.exit(0)
+                else:
+                        if arg_sel == 'WALKFILES':
+                                s_walkdir = arg
+                        elif arg_sel == 'CALIBRATION':
+                                s_calibdir = arg
+                        elif arg_sel == 'REPORT':
+                                s_report = arg
+                        elif arg_sel == 'JOBS':
+                                jobs = max(int(arg), 1)
+                        elif arg_sel == 'CYCLES':
+                                cycles = max(int(arg), 1)
+                        elif arg_sel == 'LIMIT':
+                                limit = int(arg)
+                        arg_sel = 'NONE'
+
+        log_ = logger.DefaultLogger
+        if s_calibdir != None:
+                log_.info('loaded ' + str(walkietalkie.loadCalibration(s_calibdir)) + ' calibrations')
+        if not os.path.isdir(s_walkdir):
+                log_.err('no such directory: ' + s_walkdir)
+                sys.exit(1)
+
+        paths = sorted([os.path.join(s_walkdir, f) for f in os.listdir(s_walkdir) if f.endswith('.walk')])
+        log_.info('simulating ' + str(len(paths)) + ' programs with ' + str(jobs) + ' processes...')
+        pool = multiprocessing.Pool(jobs)
+        try:
+                results = pool.map(simulateFile, [(path, cycles, limit) for path in paths])
+        finally:
+                pool.close()
+                pool.join()
+        writeReport(results, s_report)
+        failed = len([res for res in results if res['error'] != None])
+        log_.info('done, ' + str(failed) + ' of ' + str(len(results)) + ' failed')
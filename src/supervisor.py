@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+
+##
+# @file         supervisor.py
+# @author       Manuel Federanko
+# @version      0.0.0-r0
+# @since        16-12-12
+#
+# @brief        Runs one controller process per robot and restarts them when they fail.
+#
+# The robots are read from a config file with one section per robot:
+#
+#     [robot]
+#     name=left
+#     port=11121
+#     device=/dev/ttyUSB0
+#     walkdir=./walkfiles/
+#     metrics=9121
+#     [end]
+#
+# `device` may be given several times, like the -d option, a robot without one writes to
+# os.devnull. `metrics` is optional. The processes are forked, so everything loaded before
+# starting the Supervisor is shared with them.
+##
+
+#
+# IMPORTS
+#
+import multiprocessing
+import time
+import os
+
+import walkietalkie
+
+#
+# PRIVATE VARIABLES and FUNCTIONS
+#
+
+##
+# Loads the robots from a config file, see the file description for the format.
+# @param path   the config file
+# @returns      a list of Robots
+def loadConfig(path):
+        robots = []
+        robot = None
+        with open(path, 'r') as f:
+                for line in f:
+                        line = line.split('#', 1)[0].strip()
+                        if not line:
+                                continue
+                        if line == '[robot]':
+                                robot = Robot('robot' + str(len(robots)))
+                        elif line == '[end]':
+                                if robot != None:
+                                        if len(robot.devices) == 0:
+                                                robot.devices.append(os.devnull)
+                                        robots.append(robot)
+                                robot = None
+                        elif robot != None:
+                                k, v = walkietalkie.splitAssignment(line)
+                                if k == 'name':
+                                        robot.name = v
+                                elif k == 'port':
+                                        robot.port = int(v)
+                                elif k == 'device':
+                                        robot.devices.append(v)
+                                elif k == 'walkdir':
+                                        robot.walkdir = v
+                                elif k == 'metrics':
+                                        robot.metrics = int(v)
+        return robots
+
+#
+# CLASSES
+#
+
+##
+# The configuration and state of one supervised robot.
+class Robot:
+
+        def __init__(self, name):
+                self.name = name
+                self.port = 11111
+                self.devices = []
+                self.walkdir = './walkfiles/'
+                self.metrics = None
+                self.process = None
+                self.heartbeat = multiprocessing.Value('d', 0.0)
+                self.restarts = 0
+                self.started = 0
+                self.next_start = 0
+                self.backoff = 0
+
+        def __repr__(self):
+                state = 'down'
+                if self.process != None and self.process.is_alive():
+                        state = 'up (pid ' + str(self.process.pid) + ')'
+                return 'Robot()[name=' + self.name + ', port=' + str(self.port) + ', devices=' + str(self.devices) + ', walkdir=' + self.walkdir + ', state=' + state + ', restarts=' + str(self.restarts) + ']'
+
+##
+# Starts a process per robot and watches them. A process which exits or stops updating its
+# heartbeat for HEARTBEAT_TIMEOUT ms is (re)started, waiting RESTART_DELAY ms at first and
+# doubling the wait on every failure in a row up to RESTART_DELAY_MAX ms. The state of every
+# robot is logged every REPORT_RATE ms.
+class Supervisor:
+
+        HEARTBEAT_TIMEOUT = 5000
+        RESTART_DELAY = 1000
+        RESTART_DELAY_MAX = 30000
+        ##
+        # A robot running this long without a failure resets its restart delay.
+        STABLE_TIME = 60000
+        REPORT_RATE = 60000
+
+        ##
+        # @param robots the Robots to run
+        # @param target the function run in every process as target(robot, heartbeat)
+        # @param logger the Logger
+        def __init__(self, robots, target, logger):
+                self.robots = robots
+                self.target = target
+                self.logger = logger
+                self.ctx = multiprocessing.get_context('fork')
+                self.looping = True
+                self.reported = 0
+
+        def _start(self, robot):
+                robot.heartbeat.value = time.time()
+                robot.process = self.ctx.Process(target = self.target, args = (robot, robot.heartbeat), name = robot.name)
+                robot.process.daemon = True
+                robot.process.start()
+                robot.started = walkietalkie.getTime()
+                self.logger.info('started robot ' + robot.name + ' (pid ' + str(robot.process.pid) + ')')
+
+        def _failed(self, robot, reason):
+                now = walkietalkie.getTime()
+                if now - robot.started >= Supervisor.STABLE_TIME:
+                        robot.backoff = Supervisor.RESTART_DELAY
+                else:
+                        robot.backoff = min(max(2*robot.backoff, Supervisor.RESTART_DELAY), Supervisor.RESTART_DELAY_MAX)
+                robot.next_start = now + robot.backoff
+                robot.process = None
+                robot.restarts += 1
+                self.logger.warn('robot ' + robot.name + ' ' + reason + ', restarting in ' + str(robot.backoff) + 'ms')
+
+        ##
+        # Checks every robot once and restarts the failed ones when their delay has passed.
+        def do(self):
+                now = walkietalkie.getTime()
+                for robot in self.robots:
+                        if robot.process == None:
+                                if now >= robot.next_start:
+                                        self._start(robot)
+                        elif not robot.process.is_alive():
+                                self._failed(robot, 'exited with ' + str(robot.process.exitcode))
+                        elif 1000*(time.time() - robot.heartbeat.value) > Supervisor.HEARTBEAT_TIMEOUT:
+                                robot.process.terminate()
+                                robot.process.join(1.0)
+                                self._failed(robot, 'stopped responding')
+                if now - self.reported >= Supervisor.REPORT_RATE:
+                        self.reported = now
+                        for line in self.report():
+                                self.logger.info(line)
+
+        ##
+        # Returns the state of every robot.
+        # @returns      a list of strings
+        def report(self):
+                return [repr(robot) for robot in self.robots]
+
+        ##
+        # Terminates all processes.
+        def stop(self):
+                self.looping = False
+                for robot in self.robots:
+                        if robot.process != None:
+                                robot.process.terminate()
+                                robot.process.join(1.0)
+                                robot.process = None
+
+        ##
+        # Supervises the robots until interrupted.
+        def run(self):
+                try:
+                        while self.looping:
+                                self.do()
+                                time.sleep(0.1)
+                except KeyboardInterrupt:
+                        pass
+                finally:
+                        self.stop()
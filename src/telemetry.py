@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+
+##
+# @file         telemetry.py
+# @author       agent
+# @version      0.0.0-r0
+# @since        26-10-19
+#
+# @brief        Publishes the state of the FileWalker to any number of subscribers.
+#
+# Every subscriber is an udp endpoint with its own rate. There is no queue per subscriber,
+# a record is built from the current state when it is due, so slow subscribers simply
+# receive the latest values less often and the motion loop never waits on the network.
+##
+
+#
+# IMPORTS
+#
+import socket
+
+import walkietalkie
+
+#
+# CLASSES
+#
+
+##
+# A single endpoint receiving telemetry records.
+class Subscriber:
+
+        ##
+        # @param addr   the (host, port) tuple to send the records to
+        # @param rate   the minimum time between two records in ms
+        def __init__(self, addr, rate):
+                self.addr = addr
+                self.rate = rate
+                self.last = 0
+                self.sent = 0
+                self.dropped = 0
+
+        def __repr__(self):
+                return 'Subscriber()[addr=' + str(self.addr[0]) + ':' + str(self.addr[1]) + ', rate=' + str(self.rate) + ', sent=' + str(self.sent) + ', dropped=' + str(self.dropped) + ']'
+
+##
+# Keeps the list of subscribers and pushes records to them.
+# The records are single lines of the form
+# `tel t=<ms> prg=<name> sec=<init|prg> stp=<pos> late=<ms> uart=<frames>/<bytes> pos=<raw,...>`.
+class Telemetry:
+
+        DEFAULT_RATE = 100
+
+        def __init__(self, logger):
+                self.logger = logger
+                self.fw = None
+                self.subs = {}
+                self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                self.sock.setblocking(False)
+
+        ##
+        # Sets the FileWalker whose state is published.
+        # @param fw     the FileWalker
+        def setFilewalker(self, fw):
+                self.fw = fw
+
+        ##
+        # Adds a subscriber or changes the rate of an existing one.
+        # @param addr   the (host, port) tuple of the subscriber
+        # @param rate   the rate in ms
+        def subscribe(self, addr, rate = DEFAULT_RATE):
+                if addr in self.subs:
+                        self.subs[addr].rate = rate
+                else:
+                        self.subs[addr] = Subscriber(addr, rate)
+
+        ##
+        # Removes a subscriber.
+        # @param addr   the (host, port) tuple of the subscriber
+        # @returns      True if the subscriber was known
+        def unsubscribe(self, addr):
+                if addr in self.subs:
+                        del self.subs[addr]
+                        return True
+                return False
+
+        ##
+        # Builds a record from the current state of the FileWalker.
+        # @param now    the timestamp of the record
+        # @returns      the record
+        def record(self, now):
+                rec = 'tel t=' + str(now)
+                fw = self.fw
+                if fw == None:
+                        return rec
+                if fw.select != None:
+                        rec += ' prg=' + fw.select.name.replace(' ', '_')
+                        rec += ' sec=' + ('prg' if fw.inited else 'init')
+                        rec += ' stp=' + str(fw.pos)
+                else:
+                        rec += ' prg=- sec=- stp=-'
+                rec += ' late=' + str(fw.lateness)
+                if fw.motd != None:
+                        rec += ' uart=' + str(fw.motd.frames) + '/' + str(fw.motd.bytes)
+                if fw.last_step != None:
+                        rec += ' pos=' + ','.join([str(v) for v in fw.last_step.pos])
+                return rec
+
+        ##
+        # Sends the latest record to every subscriber which is due.
+        # Sending never blocks, if the socket can't take the record it is dropped and the
+        # subscriber gets the next, more recent one.
+        def do(self):
+                if len(self.subs) == 0:
+                        return
+                now = walkietalkie.getTime()
+                data = None
+                for sub in self.subs.values():
+                        if now - sub.last < sub.rate:
+                                continue
+                        if data == None:
+                                data = (self.record(now) + '\n').encode('UTF-8')
+                        sub.last = now
+                        try:
+                                self.sock.sendto(data, sub.addr)
+                                sub.sent += 1
+                        except socket.error:
+                                sub.dropped += 1
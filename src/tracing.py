@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+
+##
+# @file         tracing.py
+# @author       agent
+# @version      0.0.0-r0
+# @since        26-10-19
+#
+# @brief        Records the stages a command or Step passes through, as Chrome trace events.
+#
+# A trace is started when a command is received or a Step is due, every stage it passes records a
+# span with the id of the trace: cliRead, parse, dispatch, doStep and send for every packet. The
+# spans can be written as trace-event JSON and opened in chrome://tracing or Perfetto.
+# Tracing is off by default, then stamp() returns None and add() returns right away.
+##
+
+#
+# IMPORTS
+#
+import collections
+import threading
+import json
+import time
+import os
+
+#
+# PRIVATE VARIABLES and FUNCTIONS
+#
+_clock = getattr(time, 'perf_counter', time.time)
+
+##
+# Returns the time of the trace clock in us.
+# @returns      the time
+def _now():
+        return int(_clock() * 1000000)
+
+#
+# CLASSES
+#
+
+##
+# Keeps the recorded spans in a bounded buffer, the oldest ones are dropped first.
+class Tracer:
+
+        MAX_EVENTS = 65536
+
+        def __init__(self):
+                self.enabled = False
+                self.events = collections.deque(maxlen = Tracer.MAX_EVENTS)
+                self.next_id = 1
+                self.current = 0
+
+        def __repr__(self):
+                return 'Tracer()[enabled=' + str(self.enabled) + ', events=' + str(len(self.events)) + ', traces=' + str(self.next_id - 1) + ']'
+
+        ##
+        # Starts recording.
+        def start(self):
+                self.enabled = True
+
+        ##
+        # Stops recording, the recorded spans are kept.
+        def stop(self):
+                self.enabled = False
+
+        ##
+        # Drops all recorded spans.
+        def clear(self):
+                self.events.clear()
+
+        ##
+        # Starts a new trace, the following spans belong to it.
+        # @returns      the id of the trace
+        def begin(self):
+                self.current = self.next_id
+                self.next_id += 1
+                return self.current
+
+        ##
+        # Returns the start time of a span.
+        # @returns      the time in us or None if tracing is off
+        def stamp(self):
+                if not self.enabled:
+                        return None
+                return _now()
+
+        ##
+        # Records a span ending now.
+        # @param name   the name of the stage
+        # @param t0     the start time from stamp(), nothing is recorded if it is None
+        # @param trace  the id of the trace, the current one if None
+        # @param args   a dict of additional values or None
+        def add(self, name, t0, trace = None, args = None):
+                if t0 == None:
+                        return
+                if trace == None:
+                        trace = self.current
+                self.events.append((name, t0, _now() - t0, threading.current_thread().ident, trace, args))
+
+        ##
+        # Writes the recorded spans as Chrome trace-event JSON.
+        # @param path   the file
+        # @returns      the number of spans written
+        def dump(self, path):
+                pid = os.getpid()
+                evs = []
+                for (name, t0, dur, thread, trace, args) in list(self.events):
+                        a = {'trace': trace}
+                        if args != None:
+                                a.update(args)
+                        evs.append({'name': name, 'cat': 'cairo', 'ph': 'X', 'ts': t0, 'dur': dur, 'pid': pid, 'tid': thread, 'args': a})
+                with open(path, 'w') as f:
+                        json.dump({'traceEvents': evs, 'displayTimeUnit': 'ms'}, f)
+                return len(evs)
+
+#
+# CODE
+#
+# The tracer used by all modules
+DefaultTracer = Tracer()
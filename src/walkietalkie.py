@@ -24,8 +24,16 @@ import abc
 import math
 import time
 import re
+import bisect
+import threading
+import collections
+try:
+        import queue
+except ImportError:
+        import Queue as queue
 # import uart
 import logger
+import tracing
 import sys
 
 #
@@ -59,9 +67,9 @@ _R_STEPPAT = re.compile(_SR_STEPPAT)
 
 
 ##
-# Returns the current system time in ms resolution as int.
+# Returns the current system time in ms resolution as int, the other modules use it as well.
 # @returns the time in ms
-def _getTime():
+def getTime():
         return int(time.time() * 1000)
 
 ##
@@ -79,6 +87,14 @@ def _ext_key_val(line):
                 yield k
                 yield v
 
+##
+# Splits a `key=value` line, the way the walk-files are read, for the other config files.
+# @param line   the line to split
+# @returns      the key and the value, both None if the line is no assignment
+def splitAssignment(line):
+        k, v = _ext_key_val(line)
+        return k, v
+
 ##
 # Loads a function from two related lines and returns true on success.
 # Both lines represent a key,value pair, with one specifying an `Interval` and the other specifying a `Function`.
@@ -149,10 +165,156 @@ def _load_step(stp, line, default_tick):
                                 return False
                 return True
 
+##
+# Encodes the positions of a Step into the packets sent to the PiCs, two bytes per servo.
+# The layout is the same as the one built by the MotorDistributor in mode zero (0), values
+# out of the domain of a byte are sent as zero (0).
+# @param pos    the raw servo positions
+# @returns      the encoded frames
+def _encode_step(pos):
+        frames = bytearray(2*len(pos))
+        for i in range(0, len(pos)):
+                val = pos[i]
+                if val < 0 or val > 0xff:
+                        val = 0
+                frames[2*i] = 0x80 | ((i // 4 + 1) << 5) | ((i % 4) << 3) | ((val >> 7) & 0x01)
+                frames[2*i + 1] = val & 0x7f
+        return bytes(frames)
+
 #
 # CLASSES
 #
 
+##
+# The calibration of a single servo. The conversions between degrees and raw pwm-values are
+# compiled into integer lookup tables, so applying trims costs nothing at runtime.
+# The uncalibrated mapping is `raw = 36 + (157-36)*deg/191`; a calibration first mirrors the
+# angle (if reversed), then applies `offset + scale*deg` and finally clamps the result to [min, max].
+class ServoCalibration:
+
+        RAW_MIN = 36
+        RAW_MAX = 157
+        DEG_MAX = 191
+        ##
+        # The deg->raw table covers [0, LUT_DEG), the raw->deg table all values a byte can hold.
+        # The rad->raw table covers the same angles in steps of 1 mrad, the resolution of the
+        # walk-files, so radians aren't rounded to full degrees.
+        LUT_DEG = 360
+        LUT_RAW = 0x100
+        LUT_MRAD = int(math.ceil(LUT_DEG*math.pi/180.0*1000))
+
+        ##
+        # Creates the identity calibration.
+        def __init__(self):
+                self.offset = 0.0
+                self.scale = 1.0
+                self.min = 0
+                self.max = 0xff
+                self.reversed = False
+                self.compile()
+
+        def __repr__(self):
+                return 'ServoCalibration()[offset=' + str(self.offset) + ', scale=' + str(self.scale) + ', min=' + str(self.min) + ', max=' + str(self.max) + ', reversed=' + str(self.reversed) + ']'
+
+        ##
+        # Loads a calibration file consisting of `key=value` lines, the keys are
+        # offset, scale, min, max and reversed. Unknown keys are ignored.
+        # @param path   the file to load
+        def load(self, path):
+                with open(path, 'r') as f:
+                        for line in f:
+                                line = line.split('#', 1)[0].strip()
+                                k, v = _ext_key_val(line)
+                                if k == None or v == None:
+                                        continue
+                                if k == 'offset':
+                                        self.offset = float(v)
+                                elif k == 'scale':
+                                        self.scale = float(v)
+                                elif k == 'min':
+                                        self.min = int(v)
+                                elif k == 'max':
+                                        self.max = int(v)
+                                elif k == 'reversed':
+                                        self.reversed = v in ['True', 'true', 'Yes', 'yes', '1']
+                self.compile()
+
+        def _toRaw(self, deg):
+                if self.reversed:
+                        deg = ServoCalibration.DEG_MAX - deg
+                deg = self.offset + self.scale*deg
+                raw = int(ServoCalibration.RAW_MIN + (ServoCalibration.RAW_MAX - ServoCalibration.RAW_MIN)*deg/float(ServoCalibration.DEG_MAX))
+                return max(self.min, min(self.max, raw))
+
+        def _toDeg(self, raw):
+                deg = (raw - ServoCalibration.RAW_MIN)*ServoCalibration.DEG_MAX/float(ServoCalibration.RAW_MAX - ServoCalibration.RAW_MIN)
+                deg = (deg - self.offset)/self.scale
+                if self.reversed:
+                        deg = ServoCalibration.DEG_MAX - deg
+                return int(deg)
+
+        ##
+        # Rebuilds the lookup tables, this must be called after changing any of the parameters.
+        def compile(self):
+                self.deg_raw = array('i', [self._toRaw(d) for d in range(0, ServoCalibration.LUT_DEG)])
+                self.raw_deg = array('i', [self._toDeg(r) for r in range(0, ServoCalibration.LUT_RAW)])
+                self.rad_raw = array('i', [self._toRaw(m/1000.0*180.0/math.pi) for m in range(0, ServoCalibration.LUT_MRAD)])
+
+        ##
+        # Converts degrees to the raw pwm-value, values outside of the table are clamped.
+        # @param v      the value in deg
+        # @returns      the raw value
+        def degToRaw(self, v):
+                v = int(v)
+                if v < 0:
+                        v = 0
+                elif v >= ServoCalibration.LUT_DEG:
+                        v = ServoCalibration.LUT_DEG - 1
+                return self.deg_raw[v]
+
+        ##
+        # Converts radians to the raw pwm-value, the angle is rounded to full mrad, values outside
+        # of the table are clamped.
+        # @param v      the value in rad
+        # @returns      the raw value
+        def radToRaw(self, v):
+                v = int(round(float(v)*1000.0))
+                if v < 0:
+                        v = 0
+                elif v >= ServoCalibration.LUT_MRAD:
+                        v = ServoCalibration.LUT_MRAD - 1
+                return self.rad_raw[v]
+
+        ##
+        # Converts a raw pwm-value back to degrees.
+        # @param v      the raw value
+        # @returns      the value in deg
+        def rawToDeg(self, v):
+                v = int(v)
+                if v < 0:
+                        v = 0
+                elif v >= ServoCalibration.LUT_RAW:
+                        v = ServoCalibration.LUT_RAW - 1
+                return self.raw_deg[v]
+
+##
+# The calibrations of all 12 servos, used by every conversion between degrees and raw values.
+DefaultCalibration = [ServoCalibration() for _ in range(0, 12)]
+
+##
+# Loads the calibration files `servo<N>.cal` (N = 0..11) from a directory into
+# DefaultCalibration. Servos without a file keep their calibration.
+# @param path   the directory to search
+# @returns      the number of loaded files
+def loadCalibration(path):
+        n = 0
+        for i in range(0, len(DefaultCalibration)):
+                fpath = os.path.join(path, 'servo' + str(i) + '.cal')
+                if os.path.isfile(fpath):
+                        DefaultCalibration[i].load(fpath)
+                        n += 1
+        return n
+
 ##
 # The Step class is used to provide an abstraction layer to the servo positions used in the program.
 # A Step consists of all 12 Servo positions and a delay. The delay specifies the time the program
@@ -164,11 +326,12 @@ class Step:
         def __init__(self):
                 self.pos = array('i', (0,)*12)
                 self.delay = 0
+                self.frames = None
 
         def __repr__(self):
                 rep = 'Step()[pos=['
                 for i in range(0, 12):
-                        rep += str(int(((self.pos[i]-36.0)*191.0)/(157.0-36.0)))
+                        rep += str(DefaultCalibration[i].rawToDeg(self.pos[i]))
                         rep += ', '
                 rep += '], delay='
                 rep += str(self.delay)
@@ -210,22 +373,21 @@ class Step:
                 if v > 157 or v < 35:
                         logger.DefaultLogger.warn('motor value out of range')
                 self.pos[p] = v
+                self.frames = None
 
         ##
         # Sets the position of the servo p to v, where v is given in radians.
         # @param p      the servo-#
         # @param v      the value of the servo in rad
         def setServoAtRad(self, p, v):
-                v = float(v)
-                self.setServoAtRaw(p, 36.0+(157.0-36.0)*v/(math.pi*191.0/180.0))
+                self.setServoAtRaw(p, DefaultCalibration[p].radToRaw(v))
 
         ##
         # Sets the position of the servo p to v, where v is given in degrees.
         # @param p      the servo-#
         # @param v      the value of the servo in deg
         def setServoAtDeg(self, p, v):
-                v = int(v)
-                self.setServoAtRaw(p, 36.0+(157.0-36.0)*v/(191.0))
+                self.setServoAtRaw(p, DefaultCalibration[p].degToRaw(v))
 
         ##
         # Provides an alias for setServoAtRaw(self, p, v).
@@ -284,6 +446,15 @@ class Step:
         def getVal(self, at):
                 return self.getRawVal(at)
 
+        ##
+        # Returns the packets for all servos of this Step, they are encoded once and cached
+        # until a position changes.
+        # @returns      the encoded frames
+        def getFrames(self):
+                if self.frames == None:
+                        self.frames = _encode_step(self.pos)
+                return self.frames
+
 ##
 # Defines a function with a domain.
 # The function is python code, which is then evaluated using the builtin eval function.
@@ -336,9 +507,14 @@ class Function:
 # MotorFunctions is basically just a list of Functions, which get used to calculate the value.
 # Here the domain of a function is put to use. When calulating the result of the Function the
 # timedifference is used. The object remembers the last_time and calculates the variable t using
-# the current time minus the last time (`time=_getTime() - self.last_time`). If the time is outside
-# of the domain of a function, then the next one is used, until a function is found or every one
-# has been tryed (in this case None is returned). Otherwise the currect value is returned.
+# the time of the current tick minus the last time (`time=now - self.last_time`).
+# The Functions are kept sorted by the start of their domain, the one in use is cached and
+# otherwise found by bisecting the starts. The following cases are handled explicitly:
+# - overlapping domains: of all Functions covering t, the one starting last wins
+# - gaps between domains: the last value of the previous Function is held
+# - t before the first domain: the first value of the first Function is held
+# - t after the last domain: None is returned, or, if looping, t wraps around by whole periods
+# - no Functions at all: None is returned
 # The last time must be reset (or looping enabled) from a program using this class, since it on itself has no means
 # of determining when to reset the last_time value.
 class MotorFunctions:
@@ -347,34 +523,183 @@ class MotorFunctions:
         # Initializes the MotorFuntions with an empty array of functions and a last_time of zero (0).
         def __init__(self):
                 self.fcs = []
+                self.starts = []
+                self.reach = []
+                self.end = 0
+                self.cur = -1
                 self.last_time = 0
 
         def __repr__(self):
                 return 'MotorFunctions()[' + 'self.fcs=' + str(self.fcs) + ']'
 
         ##
-        # Append a function to the list of Functions.
+        # Returns the value at the start of the first domain, or None if there are no Functions.
+        # @returns      the first position
+        def getFirstPos(self):
+                if len(self.fcs) == 0:
+                        return None
+                return self.fcs[0].getNextPos(self.starts[0])
+
+        ##
+        # Append a function to the list of Functions, keeping the list sorted by the start of the domains.
         # @param fc     the Function to append
         def append(self, fc):
-                self.fcs.append(fc)
+                i = bisect.bisect_right(self.starts, fc.int_min)
+                self.fcs.insert(i, fc)
+                self.starts.insert(i, fc.int_min)
+                # reach[i] is the end of the domain reaching furthest among fcs[0..i]
+                self.reach = []
+                for f in self.fcs:
+                        self.reach.append(f.int_max if len(self.reach) == 0 else max(self.reach[-1], f.int_max))
+                self.end = self.reach[-1]
+                self.cur = -1
+
+        ##
+        # Returns the index of the Function whose domain starts last at or before t.
+        # The previously used index is tried first, since consecutive ticks mostly stay in the same domain.
+        # @param t      the time, must not be before the first start
+        # @returns      the index into self.fcs
+        def _find(self, t):
+                cur = self.cur
+                if cur >= 0 and self.starts[cur] <= t and (cur + 1 == len(self.starts) or self.starts[cur + 1] > t):
+                        return cur
+                self.cur = bisect.bisect_right(self.starts, t) - 1
+                return self.cur
 
         ##
         # Returns the next value of the Function combinition. This is achieved by first determining the
         # the correct Function to use for calculations based on the domain and then returning its value.
-        # Looping is essentially the "reset" of the last_time to _getTime() and then calling this method
-        # again, thus ensuring that always a value unequal None will be returned.
+        # Looping moves the last_time forward by whole periods (first start to last end), so the phase is kept.
         # @param loop   if the function should loop
+        # @param now    the time of the current tick, shared by all motors
         # @returns      the next position, or None
-        def getNextPos(self, loop):
-                time = _getTime() - self.last_time
-                for i in range(0, len(self.fcs)):
-                        if time >= self.fcs[i].int_min and time <= self.fcs[i].int_max:
-                                ret = self.fcs[i].getNextPos(time)
-                                return ret
-                if loop:
-                        self.last_time = _getTime() - self.fcs[0].int_min
-                        return self.getNextPos(loop)
-                return None
+        def getNextPos(self, loop, now):
+                if len(self.fcs) == 0:
+                        return None
+                time = now - self.last_time
+                start = self.starts[0]
+                if time > self.end:
+                        if not loop:
+                                return None
+                        time = start + (time - start) % (self.end - start + 1)
+                        self.last_time = now - time
+                if time < start:
+                        time = start
+                i = self._find(time)
+                fc = self.fcs[i]
+                if time > fc.int_max:
+                        r = self.reach[i]
+                        if r < time:
+                                # a gap, hold the last value of the Function which ended last
+                                while self.fcs[i].int_max != r:
+                                        i -= 1
+                                fc = self.fcs[i]
+                                time = r
+                        else:
+                                # an earlier Function overlaps and still covers t
+                                while self.fcs[i].int_max < time:
+                                        i -= 1
+                                fc = self.fcs[i]
+                return fc.getNextPos(time)
+
+##
+# A list of Steps made of blocks which may be shared, so repeated blocks are stored once.
+# A block is a list of Steps or another StepList, a repeat adds the same block several times.
+# The flattened length is kept up to date, indexing finds the block with a binary search.
+# Changing a Step in a shared block changes it at every place the block is used.
+class StepList:
+
+        def __init__(self):
+                self.blocks = []
+                self.ends = []
+                self.tail = None
+
+        def __repr__(self):
+                return 'StepList()[len=' + str(len(self)) + ', blocks=' + str(len(self.blocks)) + ']'
+
+        def __len__(self):
+                if len(self.ends) == 0:
+                        return 0
+                return self.ends[-1]
+
+        def __getitem__(self, i):
+                n = len(self)
+                if i < 0:
+                        i += n
+                if i < 0 or i >= n:
+                        raise IndexError('StepList index out of range')
+                j = bisect.bisect_right(self.ends, i)
+                if j > 0:
+                        i -= self.ends[j - 1]
+                return self.blocks[j][i]
+
+        def __iter__(self):
+                for block in self.blocks:
+                        for stp in block:
+                                yield stp
+
+        ##
+        # Appends a single Step, it is never shared with other blocks.
+        # @param stp    the Step
+        def append(self, stp):
+                if self.tail == None:
+                        self.tail = []
+                        self.blocks.append(self.tail)
+                        self.ends.append(len(self))
+                self.tail.append(stp)
+                self.ends[-1] += 1
+
+        ##
+        # Appends a block by reference.
+        # @param block  the list of Steps or StepList to append, it must not change afterwards
+        # @param times  how often the block is repeated
+        def extend(self, block, times = 1):
+                if len(block) == 0:
+                        return
+                for _ in range(0, times):
+                        self.blocks.append(block)
+                        self.ends.append(len(self) + len(block))
+                self.tail = None
+
+##
+# The Steps of a 'prg' Program flattened into one array, setup section first, with the time at
+# which every Step starts. Times are program time in ms, the delays as written.
+# Only seeking looks Steps up by time, playback walks the sections with the position of the
+# FileWalker, which seek() sets from the index found here.
+class Timeline:
+
+        ##
+        # @param prg    the Program
+        def __init__(self, prg):
+                self.steps = list(prg.init_steps) + list(prg.prg_steps)
+                self.setup = len(prg.init_steps)
+                self.starts = []
+                t = 0
+                for stp in self.steps:
+                        self.starts.append(t)
+                        t += stp.delay
+                self.duration = t
+
+        def __repr__(self):
+                return 'Timeline()[steps=' + str(len(self.steps)) + ', setup=' + str(self.setup) + ', duration=' + str(self.duration) + ']'
+
+        def __len__(self):
+                return len(self.steps)
+
+        ##
+        # Returns the index of the Step playing at time t.
+        # @param t      the time in ms, it is clamped to the timeline
+        # @returns      the index
+        def find(self, t):
+                return min(max(bisect.bisect_right(self.starts, t) - 1, 0), len(self.steps) - 1)
+
+        ##
+        # Returns the time at which the prg section starts.
+        # @returns      the time in ms
+        def loopStart(self):
+                if self.setup < len(self.steps):
+                        return self.starts[self.setup]
+                return self.duration
 
 ##
 # An object describing a walk-file in a easy to use form for the Walker.
@@ -407,6 +732,9 @@ class Program:
         ##
         # End a region.
         TAG_END = '[end]'
+        ##
+        # Reference a named sequence in a region of steps, followed by the name.
+        TAG_REF = '@'
 
         _LOADING_NONE = 0
         _LOADING_FINFO = 1
@@ -414,9 +742,16 @@ class Program:
         _LOADING_SETUP = 3
         _LOADING_PROG = 4
         _LOADING_M = 5
+        _LOADING_SEQ = 6
 
         _SR_TAGM = '^\[m[0-9]+\]$'
         _R_TAGM = re.compile(_SR_TAGM)
+        _SR_TAGSEQ = '^\[seq +[a-zA-Z0-9_]+\]$'
+        _R_TAGSEQ = re.compile(_SR_TAGSEQ)
+        _SR_TAGREPEAT = '^\[repeat +[0-9]+\]$'
+        _R_TAGREPEAT = re.compile(_SR_TAGREPEAT)
+        _SR_TAGINCLUDE = '^\[include +[^\]]+\]$'
+        _R_TAGINCLUDE = re.compile(_SR_TAGINCLUDE)
 
         ##
         # Initializes all variables to null, empty strings/lists, zero (0) or booleans to False.
@@ -431,9 +766,14 @@ class Program:
                 self.looping = False
                 self.tick = 0
                 self.use = 'None'
-                self.init_steps = []
-                self.prg_steps = []
+                self.init_steps = StepList()
+                self.prg_steps = StepList()
                 self.mot_fcs = []
+                self.seqs = {}
+                self.includes = {}
+                self.timeline = None
+                self.begin()
+                self.complete = True
 
                 for _ in range(0,12):
                         self.mot_fcs.append(MotorFunctions())
@@ -447,94 +787,198 @@ class Program:
         # If one were to define a second 'prg' section, then those instructions would just be
         # appended to the already loaded list of steps. Generally this is no problem, but
         # bear in mind, that the last definition of a section generally is the one that counts.
+        #
+        # Regions of steps (setup, prg and named sequences) may contain:
+        # - `[repeat N]` ... `[end]`: the enclosed steps N times, repeats can be nested
+        # - `@NAME`: the steps of the sequence defined before by `[seq NAME]` ... `[end]`
+        # - `[include PATH]`: the steps of another file, relative to this one, which holds
+        #   nothing but the content of a region of steps
+        # None of them copies any Step, see StepList.
         def load(self):
-                loading = 0
-                mot_nr = -1
-                unlock = False
-                line0 = None
+                self.begin()
                 with open(self.fil_path, 'r') as f:
                         for line in f:
-                                line = line.split('#', 1)[0].strip()
-                                if not line or line.isspace():
-                                        continue
+                                self.feed(line)
+                self.finish()
 
+        ##
+        # Starts loading the program line by line, see feed() and finish().
+        # Until finish() is called the program is incomplete and may be played, see isPlayable().
+        def begin(self):
+                self.complete = False
+                self.invalidate()
+                self._loading = Program._LOADING_NONE
+                self._mot_nr = -1
+                self._unlock = False
+                self._line0 = None
+                self._stack = []
+                self._seq = None
+                self._prg_seen = False
 
-                                if loading == Program._LOADING_NONE:
-                                        # print line
-                                        if line == Program.FINFO_START:
-                                                loading = Program._LOADING_FINFO
-                                        elif line == Program.TAG_INFO:
-                                                loading = Program._LOADING_INFO
-                                        elif line == Program.TAG_SETUP:
-                                                loading = Program._LOADING_SETUP
-                                        elif line == Program.TAG_PROG:
-                                                loading = Program._LOADING_PROG
-                                        elif Program._R_TAGM.match(line) != None:
-                                                mot_nr = re.findall(r'[0-9]+', line)[0]
-                                                loading = Program._LOADING_M
-                                        else:
-                                                continue
+        ##
+        # Loads the next line of the program, see load() for the format.
+        # @param line   the line
+        def feed(self, line):
+                line = line.split('#', 1)[0].strip()
+                if not line or line.isspace():
+                        return
+
+
+                if self._loading == Program._LOADING_NONE:
+                        # print line
+                        if line == Program.FINFO_START:
+                                self._loading = Program._LOADING_FINFO
+                        elif line == Program.TAG_INFO:
+                                self._loading = Program._LOADING_INFO
+                        elif line == Program.TAG_SETUP:
+                                self._loading = Program._LOADING_SETUP
+                                self._stack = [(self.init_steps, 1)]
+                        elif line == Program.TAG_PROG:
+                                self._loading = Program._LOADING_PROG
+                                self._stack = [(self.prg_steps, 1)]
+                                self._prg_seen = True
+                        elif Program._R_TAGSEQ.match(line) != None:
+                                self._seq = line[5:-1].strip()
+                                self._loading = Program._LOADING_SEQ
+                                self._stack = [(StepList(), 1)]
+                        elif Program._R_TAGM.match(line) != None:
+                                self._mot_nr = re.findall(r'[0-9]+', line)[0]
+                                self._loading = Program._LOADING_M
+                        else:
+                                return
+                else:
+                        if self._loading in [Program._LOADING_SETUP, Program._LOADING_PROG, Program._LOADING_SEQ]:
+                                if self._loadStepLine(self._stack, line):
+                                        return
+                                if self._loading == Program._LOADING_SEQ:
+                                        self.seqs[self._seq] = self._stack[0][0]
+                                self._loading = Program._LOADING_NONE
+                                return
+
+                        if self._loading == Program._LOADING_FINFO and line == Program.FINFO_STOP or line == Program.TAG_END:
+                                self._loading = Program._LOADING_NONE
+                                self._mot_nr = -1
+                                return
+                        
+                        # load the basic file info
+                        if self._loading == Program._LOADING_FINFO:
+                                k, v = _ext_key_val(line)
+                                if k == None or v == None:
+                                        return
+                                if k == 'version':
+                                        self.file_version = v
+                        elif self._loading == Program._LOADING_INFO:
+                                k, v = _ext_key_val(line)
+                                if k == None or v == None:
+                                        return
+
+                                if k == 'Id':
+                                        self.id = int(v)
+                                elif k == 'Version':
+                                        self.prg_version = v
+                                elif k == 'Name':
+                                        self.name = v
+                                elif k == 'Speed':
+                                        self.speed = int(v)
+                                elif k == 'Looping':
+                                        self.looping = v in ['True', 'true', 'Yes', 'yes', '1']
+                                elif k == 'Tick':
+                                        self.tick = int(v)
+                                elif k == 'Use':
+                                        self.use = v
+                        elif self._loading == Program._LOADING_M:
+                                
+                                # print line
+                                if not self._unlock and line == '-':
+                                        self._unlock = True
+                                        return
+                                elif not self._unlock:
+                                        return
+
+                                if self._line0 == None:
+                                        self._line0 = line
                                 else:
-                                        if loading == Program._LOADING_FINFO and line == Program.FINFO_STOP or line == Program.TAG_END:
-                                                loading = Program._LOADING_NONE
-                                                mot_nr = -1
-                                                continue
-                                        
-                                        # load the basic file info
-                                        if loading == Program._LOADING_FINFO:
-                                                k, v = _ext_key_val(line)
-                                                if k == None or v == None:
-                                                        continue
-                                                if k == 'version':
-                                                        self.file_version = v
-                                        elif loading == Program._LOADING_INFO:
-                                                k, v = _ext_key_val(line)
-                                                if k == None or v == None:
-                                                        continue
-
-                                                if k == 'Id':
-                                                        self.id = int(v)
-                                                elif k == 'Version':
-                                                        self.prg_version = v
-                                                elif k == 'Name':
-                                                        self.name = v
-                                                elif k == 'Speed':
-                                                        self.speed = int(v)
-                                                elif k == 'Looping':
-                                                        self.looping = v in ['True', 'true', 'Yes', 'yes', '1']
-                                                elif k == 'Tick':
-                                                        self.tick = int(v)
-                                                elif k == 'Use':
-                                                        self.use = v
-                                        elif loading == Program._LOADING_SETUP:
-                                                stp = Step()
-                                                if _load_step(stp, line, self.tick):
-                                                        self.init_steps.append(stp)
-                                        elif loading == Program._LOADING_PROG:
-                                                stp = Step()
-                                                if _load_step(stp, line, self.tick):
-                                                        self.prg_steps.append(stp)
-                                        elif loading == Program._LOADING_M:
-                                                
-                                                # print line
-                                                if not unlock and line == '-':
-                                                        unlock = True
-                                                        continue
-                                                elif not unlock:
-                                                        continue
-
-                                                if line0 == None:
-                                                        line0 = line
-                                                else:
-                                                        fc = Function()
-                                                        if _load_fc(fc, line0, line):
-                                                                self.mot_fcs[int(mot_nr)].append(fc)
-                                                        unlock = False
-                                                        line0 = None
-                                                        line1 = None
+                                        fc = Function()
+                                        if _load_fc(fc, self._line0, line):
+                                                self.mot_fcs[int(self._mot_nr)].append(fc)
+                                        self._unlock = False
+                                        self._line0 = None
+                                        line1 = None
 
-                                        else:
-                                                print('error')
+                        else:
+                                print('error')
+
+        ##
+        # Ends loading the program line by line.
+        def finish(self):
+                if len(self._stack) > 1:
+                        logger.DefaultLogger.warn('unterminated repeat in ' + self.fil_path)
+                self._stack = []
+                self.complete = True
+                self.invalidate()
+
+        ##
+        # Returns wheter the program can be played while it is still being loaded: its setup section
+        # is complete and at least n Steps of its prg section have been loaded.
+        # @param n      the number of prg Steps required
+        # @returns      True if it can be played
+        def isPlayable(self, n):
+                return self.complete or (self._prg_seen and len(self.prg_steps) >= n)
+
+        ##
+        # Loads a line of a region of steps. The innermost open repeat is at the end of the stack,
+        # every entry of which is a (StepList, times) tuple.
+        # @param stack  the stack of open blocks, the first one is the region itself
+        # @param line   the line to load
+        # @returns      False if the line ends the region
+        def _loadStepLine(self, stack, line):
+                block = stack[-1][0]
+                if line == Program.TAG_END:
+                        if len(stack) == 1:
+                                return False
+                        (rep, times) = stack.pop()
+                        stack[-1][0].extend(rep, times)
+                elif Program._R_TAGREPEAT.match(line) != None:
+                        stack.append((StepList(), int(line[8:-1])))
+                elif line.startswith(Program.TAG_REF):
+                        name = line[1:].strip()
+                        if name in self.seqs:
+                                block.extend(self.seqs[name])
+                        else:
+                                logger.DefaultLogger.warn('no such sequence in ' + self.fil_path + ': ' + name)
+                elif Program._R_TAGINCLUDE.match(line) != None:
+                        block.extend(self._include(line[9:-1].strip()))
+                else:
+                        stp = Step()
+                        if _load_step(stp, line, self.tick):
+                                block.append(stp)
+                return True
+
+        ##
+        # Loads the steps of an included file, every file is only loaded once per Program.
+        # @param path   the path of the file, relative to the walk-file
+        # @returns      the StepList
+        def _include(self, path):
+                path = os.path.join(os.path.dirname(self.fil_path), path)
+                if path in self.includes:
+                        if self.includes[path] == None:
+                                logger.DefaultLogger.warn('recursive include of ' + path)
+                                return StepList()
+                        return self.includes[path]
+                self.includes[path] = None
+                stack = [(StepList(), 1)]
+                try:
+                        with open(path, 'r') as f:
+                                for line in f:
+                                        line = line.split('#', 1)[0].strip()
+                                        if line and not self._loadStepLine(stack, line):
+                                                break
+                except IOError as e:
+                        logger.DefaultLogger.warn('cannot include ' + path + ': ' + str(e))
+                if len(stack) > 1:
+                        logger.DefaultLogger.warn('unterminated repeat in ' + path)
+                self.includes[path] = stack[0][0]
+                return stack[0][0]
 
         ##
         # Performs a crude validation of the program, checking if it is possible to execute it.
@@ -558,13 +1002,216 @@ class Program:
                         return False
                 return True
 
+        ##
+        # Writes the program as walk-file. Only 'prg' programs can be written, the values are raw.
+        # @param path   the file to write
+        def save(self, path):
+                with open(path, 'w') as f:
+                        f.write(Program.FINFO_START + '\n')
+                        f.write('version=' + (self.file_version if self.file_version else '1') + '\n')
+                        f.write(Program.FINFO_STOP + '\n')
+                        f.write(Program.TAG_INFO + '\n')
+                        f.write('Id=' + str(self.id) + '\n')
+                        if self.prg_version:
+                                f.write('Version=' + self.prg_version + '\n')
+                        f.write('Name=' + self.name + '\n')
+                        if self.speed > 0:
+                                f.write('Speed=' + str(self.speed) + '\n')
+                        f.write('Looping=' + str(self.looping).lower() + '\n')
+                        f.write('Tick=' + str(self.tick) + '\n')
+                        f.write('Use=' + self.use + '\n')
+                        f.write(Program.TAG_END + '\n')
+                        for (tag, steps) in [(Program.TAG_SETUP, self.init_steps), (Program.TAG_PROG, self.prg_steps)]:
+                                f.write(tag + '\n')
+                                for stp in steps:
+                                        f.write('>' + ''.join([str(v) + ',' for v in stp.pos]) + ':' + str(stp.delay) + '\n')
+                                f.write(Program.TAG_END + '\n')
+
+        ##
+        # Returns the playback rate given by 'Speed' in percent, a speed of zero (0) or less
+        # means the program is played as written.
+        # @returns      the rate, 1.0 is normal speed
+        def getRate(self):
+                if self.speed <= 0:
+                        return 1.0
+                return self.speed / 100.0
+
+        ##
+        # Encodes the frames of all steps ahead of time, so they are ready when the program is played.
+        def encode(self):
+                self.invalidate()
+                for stp in self.init_steps:
+                        stp.getFrames()
+                for stp in self.prg_steps:
+                        stp.getFrames()
+
+        ##
+        # Drops the Timeline, so it is rebuilt when it is needed next. This must be called after
+        # changing the delays of Steps in place, begin(), finish() and encode() call it.
+        def invalidate(self):
+                self.timeline = None
+
+        ##
+        # Returns the Timeline of the program, it is built once and rebuilt if steps were added.
+        # @returns      the Timeline
+        def getTimeline(self):
+                if self.timeline == None or len(self.timeline) != len(self.init_steps) + len(self.prg_steps):
+                        self.timeline = Timeline(self)
+                return self.timeline
+
+        ##
+        # Returns the pose this program starts with after its setup section, this is the first
+        # prg step or, for 'mot', the values at the start of the motor functions.
+        # @returns      the first Step or None
+        def firstStep(self):
+                if self.use == 'prg':
+                        if len(self.prg_steps) == 0:
+                                return None
+                        return self.prg_steps[0]
+                elif self.use == 'mot':
+                        stp = Step()
+                        stp.setDelayMs(self.tick)
+                        for i in range(0, len(self.mot_fcs)):
+                                d = self.mot_fcs[i].getFirstPos()
+                                if d == None:
+                                        return None
+                                stp.setServoAtRaw(i, d)
+                        return stp
+                return None
+
+##
+# The clock all timing of the Walker is based on, by default the system time.
+class Clock:
+
+        ##
+        # Returns the current time in ms resolution as int.
+        # @returns      the time in ms
+        def now(self):
+                return getTime()
+
+        ##
+        # Waits for ms milliseconds.
+        # @param ms     the time to wait
+        def sleep(self, ms):
+                time.sleep(ms / 1000.0)
+
+##
+# A clock which only advances when told to, for running programs faster than real time.
+# Sleeping advances it instantly and jump() moves it straight to the next deadline.
+class VirtualClock(Clock):
+
+        ##
+        # @param start  the initial time in ms
+        def __init__(self, start = 0):
+                self.t = start
+
+        def now(self):
+                return int(self.t)
+
+        def sleep(self, ms):
+                self.t += ms
+
+        ##
+        # Moves the clock forward to t, it never runs backwards.
+        # @param t      the time to jump to in ms
+        def jump(self, t):
+                if t > self.t:
+                        self.t = t
+
+##
+# The clock used if none is given.
+DefaultClock = Clock()
+
+##
+# Records poses as they are applied and turns them into a 'prg' Program. Every pose is
+# timestamped, the delay of a Step is the time until the next pose was applied.
+class Recorder:
+
+        ##
+        # @param name   the name of the Program to create
+        # @param start  the Step the robot is in when recording starts, or None
+        # @param now    the current time in ms
+        def __init__(self, name, start, now):
+                self.name = name
+                self.start = start
+                self.pose = array('i', (0,)*12)
+                if start != None:
+                        self.pose = array('i', start.pos)
+                self.poses = []
+
+        ##
+        # Records a complete pose.
+        # @param pos    the 12 raw values
+        # @param now    the time at which the pose was applied
+        def addPose(self, pos, now):
+                self.pose = array('i', pos)
+                self.poses.append((now, array('i', self.pose)))
+
+        ##
+        # Records a change of a single servo, the others keep their last recorded value.
+        # @param idx    the servo-#
+        # @param raw    the raw value
+        # @param now    the time at which the value was applied
+        def setServo(self, idx, raw, now):
+                self.pose[idx] = raw
+                self.poses.append((now, array('i', self.pose)))
+
+        ##
+        # Creates the Program from the recorded poses. The pose at the start of the recording becomes
+        # the setup, the last pose is held until the end of the recording. If thin is not None, consecutive
+        # equal poses are merged and poses held for less than thin ms are dropped in favour of the following one.
+        # @param tick   the tick of the Program
+        # @param thin   the minimum time a pose must be held to be kept, or None
+        # @param end    the time the recording ended, if None the last pose gets the tick as delay
+        # @returns      the Program
+        def toProgram(self, tick, thin = None, end = None):
+                prg = Program('<record:' + self.name + '>')
+                prg.name = self.name
+                prg.tick = tick
+                prg.use = 'prg'
+                if self.start != None:
+                        stp = Step()
+                        stp.setStepsRaw(self.start.pos)
+                        stp.setDelayMs(tick)
+                        prg.init_steps.append(stp)
+                steps = []
+                for i in range(0, len(self.poses)):
+                        (t, pos) = self.poses[i]
+                        delay = tick
+                        if i + 1 < len(self.poses):
+                                delay = self.poses[i + 1][0] - t
+                        elif end != None:
+                                delay = max(end - t, 0)
+                        if thin != None and len(steps) > 0:
+                                last = steps[-1]
+                                if last[1] == pos:
+                                        last[0] += delay
+                                        continue
+                                if last[0] < thin:
+                                        last[0] += delay
+                                        last[1] = pos
+                                        continue
+                        steps.append([delay, pos])
+                for (delay, pos) in steps:
+                        stp = Step()
+                        stp.setStepsRaw(pos)
+                        stp.setDelayMs(delay)
+                        prg.prg_steps.append(stp)
+                prg.encode()
+                return prg
+
 ##
 # Provides an ABC for executing some steps.
 class Walker:
         __metaclass__ = abc.ABCMeta
 
-        def __init__(self):
-                self.time = _getTime()
+        ##
+        # @param clock  the Clock to use, DefaultClock if None
+        def __init__(self, clock = None):
+                if clock == None:
+                        clock = DefaultClock
+                self.clock = clock
+                self.time = self.clock.now()
                 self.target_diff = 0
 
         ##
@@ -596,6 +1243,221 @@ class Walker:
         def doTick(self):
                 pass
 
+##
+# Counters describing the health of an uart connection, as seen by the UartReader.
+class UartHealth:
+
+        def __init__(self):
+                self.sent = 0
+                self.echoed = 0
+                self.lost = 0
+                self.garbled = 0
+                self.unexpected = 0
+                self.overflow = 0
+                self.rtt_last = 0
+                self.rtt_min = 0
+                self.rtt_max = 0
+                self.rtt_sum = 0
+
+        def __repr__(self):
+                avg = 0
+                if self.echoed > 0:
+                        avg = self.rtt_sum // self.echoed
+                return 'UartHealth()[sent=' + str(self.sent) + ', echoed=' + str(self.echoed) + ', lost=' + str(self.lost) + ', garbled=' + str(self.garbled) + ', unexpected=' + str(self.unexpected) + ', overflow=' + str(self.overflow) + ', rtt_us=' + str(self.rtt_last) + '/' + str(self.rtt_min) + '/' + str(avg) + '/' + str(self.rtt_max) + ']'
+
+        ##
+        # Records the round-trip time of an echoed frame.
+        # @param rtt    the time in us
+        def addRtt(self, rtt):
+                if self.echoed == 0 or rtt < self.rtt_min:
+                        self.rtt_min = rtt
+                if rtt > self.rtt_max:
+                        self.rtt_max = rtt
+                self.rtt_last = rtt
+                self.rtt_sum += rtt
+                self.echoed += 1
+
+##
+# Reads the responses of the PiCs in the background. The PiCs echo every packet they receive,
+# a packet starts with a byte having its 7th bit set, followed by one with the 7th bit cleared.
+# Echoed packets are matched against the sent ones to measure the round-trip time, packets
+# which are not echoed within TIMEOUT us count as lost, bytes which don't form a packet as
+# garbled. Anything else is reported as status. The results are put into a bounded event queue
+# as tuples of ('echo', frame, rtt) or ('status', frame), when it is full new events are dropped.
+class UartReader(threading.Thread):
+
+        TIMEOUT = 100000
+        QUEUE_LEN = 256
+
+        ##
+        # @param uart   the connection to read from, it must be opened for reading
+        def __init__(self, uart):
+                threading.Thread.__init__(self)
+                self.daemon = True
+                self.uart = uart
+                self.health = UartHealth()
+                self.events = queue.Queue(UartReader.QUEUE_LEN)
+                self.outstanding = collections.deque()
+                self.lock = threading.Lock()
+                self.hold = None
+
+        ##
+        # Registers a frame which has just been sent and is expected to be echoed.
+        # @param b0     the first byte
+        # @param b1     the second byte
+        def expect(self, b0, b1):
+                with self.lock:
+                        self.outstanding.append((b0, b1, int(time.time()*1000000)))
+                        self.health.sent += 1
+
+        ##
+        # Counts all frames which are not echoed in time as lost.
+        # @param now    the current time in us
+        def expire(self, now):
+                with self.lock:
+                        while len(self.outstanding) > 0 and now - self.outstanding[0][2] > UartReader.TIMEOUT:
+                                self.outstanding.popleft()
+                                self.health.lost += 1
+
+        def _event(self, ev):
+                try:
+                        self.events.put_nowait(ev)
+                except queue.Full:
+                        self.health.overflow += 1
+
+        def _received(self, b0, b1):
+                now = int(time.time()*1000000)
+                self.expire(now)
+                with self.lock:
+                        idx = -1
+                        for i in range(0, len(self.outstanding)):
+                                if self.outstanding[i][0] == b0 and self.outstanding[i][1] == b1:
+                                        idx = i
+                                        break
+                        if idx < 0:
+                                self.health.unexpected += 1
+                                ev = ('status', (b0, b1))
+                        else:
+                                # the echoes arrive in order, everything sent before is gone
+                                for _ in range(0, idx):
+                                        self.outstanding.popleft()
+                                        self.health.lost += 1
+                                sent = self.outstanding.popleft()[2]
+                                self.health.addRtt(now - sent)
+                                ev = ('echo', (b0, b1), now - sent)
+                self._event(ev)
+
+        ##
+        # Splits the received bytes into packets.
+        # @param data   the received bytes
+        def parse(self, data):
+                for b in bytearray(data):
+                        if b & 0x80:
+                                if self.hold != None:
+                                        self.health.garbled += 1
+                                self.hold = b
+                        elif self.hold == None:
+                                self.health.garbled += 1
+                        else:
+                                self._received(self.hold, b)
+                                self.hold = None
+
+        def run(self):
+                fd = self.uart.fileno()
+                while True:
+                        try:
+                                data = os.read(fd, 64)
+                        except OSError:
+                                data = None
+                        if not data:
+                                self.expire(int(time.time()*1000000))
+                                time.sleep(0.01)
+                                continue
+                        self.parse(data)
+
+##
+# The statistics of a FrameQueue.
+class WriterStats:
+
+        def __init__(self):
+                self.depth = 0
+                self.depth_max = 0
+                self.written = 0
+                self.replaced = 0
+                self.dropped = 0
+
+        def __repr__(self):
+                return 'WriterStats()[depth=' + str(self.depth) + '/' + str(self.depth_max) + ', written=' + str(self.written) + ', replaced=' + str(self.replaced) + ', dropped=' + str(self.dropped) + ']'
+
+##
+# A bounded queue of packets in which only the latest value per PiC, servo and mode is kept.
+# A packet for an address which is still queued replaces the stale one in its place, when the
+# queue is full the oldest packet is dropped. Putting never blocks.
+class FrameQueue:
+
+        QUEUE_LEN = 32
+
+        ##
+        # @param size   the maximum number of queued packets
+        def __init__(self, size = QUEUE_LEN):
+                self.size = size
+                self.frames = collections.OrderedDict()
+                self.cond = threading.Condition()
+                self.stats = WriterStats()
+
+        def __len__(self):
+                return len(self.frames)
+
+        ##
+        # Queues a packet.
+        # @param b0     the first byte
+        # @param b1     the second byte
+        # @param trace  the id of the trace the packet belongs to
+        # @param t0     the time it was queued for tracing, or None
+        def put(self, b0, b1, trace = 0, t0 = None):
+                # everything but the msb of the value, see _encode_step
+                key = b0 & 0x7e
+                with self.cond:
+                        if key in self.frames:
+                                self.stats.replaced += 1
+                        elif len(self.frames) >= self.size:
+                                self.frames.popitem(last = False)
+                                self.stats.dropped += 1
+                        self.frames[key] = (b0, b1, trace, t0)
+                        self.stats.depth_max = max(self.stats.depth_max, len(self.frames))
+                        self.cond.notify()
+
+        ##
+        # Takes the oldest packet, waiting until there is one.
+        # @returns      the (b0, b1, trace, t0) tuple
+        def get(self):
+                with self.cond:
+                        while len(self.frames) == 0:
+                                self.cond.wait()
+                        return self.frames.popitem(last = False)[1]
+
+##
+# The writer thread of a MotorDistributor, it sends the packets of its FrameQueue with the
+# pacing the PiCs need, so the caller never waits on the serial line.
+class _UartWriter(threading.Thread):
+
+        ##
+        # @param motd   the MotorDistributor writing the packets
+        def __init__(self, motd):
+                threading.Thread.__init__(self)
+                self.daemon = True
+                self.motd = motd
+                self.queue = FrameQueue()
+
+        def run(self):
+                while True:
+                        b0, b1, trace, t0 = self.queue.get()
+                        tracing.DefaultTracer.add('queue', t0, trace)
+                        t0 = tracing.DefaultTracer.stamp()
+                        self.motd._write(b0, b1)
+                        tracing.DefaultTracer.add('send', t0, trace)
+                        self.queue.stats.written += 1
+
 ##
 # The MotorDistributor is used to automate the sending of positions to the servos.
 # Since one packet consists of two (2) bytes and contains some addresses and other information,
@@ -608,6 +1470,10 @@ class MotorDistributor:
         def __init__(self, uart):
                 self.uart = uart
                 self.bts = bytearray(2)
+                self.frames = 0
+                self.bytes = 0
+                self.reader = None
+                self.writer = None
 
         def __repr__(self):
                 return '[' + hex(self.bts[0]) + ', ' + hex(self.bts[1]) + ']'
@@ -680,13 +1546,247 @@ class MotorDistributor:
                 # time.sleep(50*10.0**(-6))
                 # self.uart.putc(self.bts[1])
                 # time.sleep(50*10.0**(-6))
-                self.uart.write(bytearray([self.bts[0]]))
+                self._put(self.bts[0], self.bts[1])
+                # _ = self.uart.read()
+
+        ##
+        # Sends already encoded packets (see Step.getFrames()) with the same pacing as send().
+        # @param frames the packets, two bytes each
+        def sendFrames(self, frames):
+                for i in range(0, len(frames) - 1, 2):
+                        self._put(frames[i], frames[i + 1])
+
+        ##
+        # Starts sending in the background, send() and sendFrames() only queue the packets
+        # from then on, see FrameQueue.
+        # @returns      True if the writer is running
+        def startWriter(self):
+                if self.writer != None:
+                        return True
+                if self.uart == None:
+                        return False
+                self.writer = _UartWriter(self)
+                self.writer.start()
+                return True
+
+        ##
+        # Returns the statistics of all background writers.
+        # @returns      a list of WriterStats
+        def getWriterStats(self):
+                if self.writer == None:
+                        return []
+                self.writer.queue.stats.depth = len(self.writer.queue)
+                return [self.writer.queue.stats]
+
+        ##
+        # Starts reading back the responses of the PiCs, if the connection is a terminal
+        # opened for reading.
+        # @returns      True if the reader is running
+        def startReader(self):
+                if self.reader != None:
+                        return True
+                try:
+                        if not self.uart.readable() or not os.isatty(self.uart.fileno()):
+                                return False
+                except (AttributeError, ValueError, IOError):
+                        return False
+                self.reader = UartReader(self.uart)
+                self.reader.start()
+                return True
+
+        ##
+        # Returns the health of all read back connections.
+        # @returns      a list of UartHealth
+        def getHealth(self):
+                if self.reader == None:
+                        return []
+                self.reader.expire(int(time.time()*1000000))
+                return [self.reader.health]
+
+        ##
+        # Returns all events received since the last call.
+        # @returns      a list of events, see UartReader
+        def getEvents(self):
+                evs = []
+                if self.reader == None:
+                        return evs
+                while True:
+                        try:
+                                evs.append(self.reader.events.get_nowait())
+                        except queue.Empty:
+                                return evs
+
+        def _put(self, b0, b1):
+                tr = tracing.DefaultTracer
+                if self.writer != None:
+                        self.writer.queue.put(b0, b1, tr.current, tr.stamp())
+                else:
+                        t0 = tr.stamp()
+                        self._write(b0, b1)
+                        tr.add('send', t0)
+
+        def _write(self, b0, b1):
+                if self.reader != None:
+                        self.reader.expect(b0, b1)
+                self.uart.write(bytearray([b0]))
                 self.uart.flush()
                 time.sleep(100*10.0**(-6))
-                self.uart.write(bytearray([self.bts[1]]))
+                self.uart.write(bytearray([b1]))
                 self.uart.flush()
                 time.sleep(100*10**(-6))
-                # _ = self.uart.read()
+                self.frames += 1
+                self.bytes += 2
+
+##
+# A MotorDistributor which doesn't talk to any hardware. It records every sent Step with the
+# time of its Clock and doesn't pace the bytes, for simulations and tests.
+class RecordingDistributor(MotorDistributor):
+
+        ##
+        # @param clock  the Clock used to timestamp the frames, DefaultClock if None
+        # @param keep   wheter the frames are kept in self.sent, otherwise they are only counted
+        def __init__(self, clock = None, keep = True):
+                MotorDistributor.__init__(self, None)
+                if clock == None:
+                        clock = DefaultClock
+                self.clock = clock
+                self.keep = keep
+                self.sent = []
+
+        def send(self):
+                self.sendFrames(bytes(self.bts))
+
+        def sendFrames(self, frames):
+                self.frames += len(frames) // 2
+                self.bytes += len(frames)
+                if self.keep:
+                        self.sent.append((self.clock.now(), frames))
+
+##
+# A writer thread owning one MotorDistributor. It sends the frames handed to it and signals
+# the completion of every job, so several buses can be driven concurrently.
+class _BusWriter(threading.Thread):
+
+        ##
+        # @param motd   the MotorDistributor of the bus
+        # @param pics   the PiC addresses connected to the bus
+        def __init__(self, motd, pics):
+                threading.Thread.__init__(self)
+                self.daemon = True
+                self.motd = motd
+                self.pics = pics
+                self.jobs = []
+                self.cond = threading.Condition()
+
+        ##
+        # Hands frames to the thread.
+        # @param frames the frames to send
+        # @returns      an Event which is set once the frames have been sent
+        def submit(self, frames):
+                done = threading.Event()
+                with self.cond:
+                        self.jobs.append((frames, done))
+                        self.cond.notify()
+                return done
+
+        def run(self):
+                while True:
+                        with self.cond:
+                                while len(self.jobs) == 0:
+                                        self.cond.wait()
+                                frames, done = self.jobs.pop(0)
+                        try:
+                                self.motd.sendFrames(frames)
+                        finally:
+                                done.set()
+
+##
+# Distributes the packets over several uart devices, each serving a subset of the PiC addresses.
+# It provides the same interface as the MotorDistributor. Every device has its own writer thread,
+# a Step is split by PiC address, sent on all buses concurrently and sendFrames() returns once
+# every bus has finished. With startWriter() the buses queue the packets instead and
+# sendFrames() returns immediately.
+class MultiDistributor(MotorDistributor):
+
+        ##
+        # @param buses  a list of (MotorDistributor, [pic addresses]) tuples
+        def __init__(self, buses):
+                MotorDistributor.__init__(self, None)
+                self.buses = []
+                self.routes = {}
+                self.queued = False
+                for (motd, pics) in buses:
+                        writer = _BusWriter(motd, pics)
+                        writer.start()
+                        self.buses.append(writer)
+                        for pic in pics:
+                                self.routes[int(pic)] = writer
+
+        def _count(self):
+                self.frames = sum([bus.motd.frames for bus in self.buses])
+                self.bytes = sum([bus.motd.bytes for bus in self.buses])
+
+        def startReader(self):
+                res = False
+                for bus in self.buses:
+                        if bus.motd.startReader():
+                                res = True
+                return res
+
+        def getHealth(self):
+                res = []
+                for bus in self.buses:
+                        res += bus.motd.getHealth()
+                return res
+
+        ##
+        # Starts the background writers of all buses, sending doesn't wait for the buses then.
+        # @returns      True if every bus has a writer
+        def startWriter(self):
+                res = True
+                for bus in self.buses:
+                        if not bus.motd.startWriter():
+                                res = False
+                self.queued = res
+                return res
+
+        def getWriterStats(self):
+                res = []
+                for bus in self.buses:
+                        res += bus.motd.getWriterStats()
+                return res
+
+        def getEvents(self):
+                res = []
+                for bus in self.buses:
+                        res += bus.motd.getEvents()
+                return res
+
+        ##
+        # Sends the buffered packet on the bus of its PiC address.
+        def send(self):
+                self.sendFrames(bytes(self.bts))
+
+        ##
+        # Splits the frames by PiC address and sends them on all buses concurrently.
+        # Frames for PiCs without a bus are discarded.
+        # @param frames the packets, two bytes each
+        def sendFrames(self, frames):
+                parts = {}
+                for i in range(0, len(frames) - 1, 2):
+                        bus = self.routes.get((frames[i] >> 5) & 0x03)
+                        if bus == None:
+                                continue
+                        if not bus in parts:
+                                parts[bus] = bytearray()
+                        parts[bus] += frames[i:i + 2]
+                if self.queued:
+                        for (bus, part) in parts.items():
+                                bus.motd.sendFrames(part)
+                else:
+                        for done in [bus.submit(part) for (bus, part) in parts.items()]:
+                                done.wait()
+                self._count()
 
 ##
 # The FileWalker is the core handling object for loading and running walk-files.
@@ -694,20 +1794,53 @@ class MotorDistributor:
 # method call. The Walker can be stopped or a program unloaded.
 class FileWalker(Walker):
 
+        ##
+        # Switch the pending program in before the next Step.
+        SWITCH_STEP = 'step'
+        ##
+        # Switch the pending program in at the end of the current cycle.
+        SWITCH_CYCLE = 'cycle'
+        ##
+        # Switch the pending program in once the current one has ended, used by the playlist.
+        SWITCH_END = 'end'
+
         ##
         # Initializes all fields of this object to 0, None or empty list.
         # @param motd   the MotorDistributor to use for data transfere
-        def __init__(self, motd, logger):
-                Walker.__init__(self)
+        # @param logger the Logger
+        # @param clock  the Clock to use, DefaultClock if None
+        def __init__(self, motd, logger, clock = None):
+                Walker.__init__(self, clock)
                 self.logger = logger
                 self.motd = motd
                 self.prgs = {}
                 self.select = None
+                self.pending = None
+                self.pending_at = FileWalker.SWITCH_CYCLE
+                self.pending_blend = 0
+                self.pending_repeats = 0
+                self.pending_queued = False
+                self.blend = []
+                self.playlist = []
+                self.repeats = 0
+                self.cycles = 0
+                self.warp = 1.0
+                self.next_warp = None
+                self.rate = 1.0
+                self.pclock = 0.0
+                self.pclock_ref = self.clock.now()
                 self.pos = 0
                 self.inited = 0
                 self.starttime = 0
                 self.should_stop = False
                 self.is_stop = True
+                self.last_step = None
+                self.lateness = 0
+                self.steps = 0
+                self.switches = 0
+                self.skip = 0
+                self.paused = False
+                self.remaining = 0
 
         def __repr__(self):
                 pass
@@ -726,6 +1859,24 @@ class FileWalker(Walker):
                         return True
                 return False
 
+        ##
+        # Removes a program from the register. If it is pending it is dropped, if it is selected
+        # it is stopped right away instead of finishing its cycle.
+        # @param name   the name of the program
+        # @returns      wheter there was such a program
+        def removeProgram(self, name):
+                prg = self.prgs.pop(name, None)
+                if prg == None:
+                        return False
+                if self.pending is prg:
+                        self.pending = None
+                        self.pending_queued = False
+                if self.select is prg:
+                        self.select = None
+                        self.should_stop = False
+                        self.is_stop = True
+                return True
+
         ##
         # Selects a program from the register to use by name.
         # If a program is already selected, the method fails and returns
@@ -737,18 +1888,316 @@ class FileWalker(Walker):
         def selectProgram(self, name):
                 if self.select != None and name == None:
                         self.should_stop = True
+                        self.pending = None
+                        self.pending_queued = False
                         return True
                 if name in self.prgs:
+                        self.pending = None
+                        self.pending_queued = False
+                        self.blend = []
+                        self.repeats = 0
+                        self.cycles = 0
                         self.should_stop = False
                         self.pos = 0
                         self.inited = 0
-                        self.starttime = _getTime()
+                        self.starttime = self._progTime()
                         self.select = self.prgs[name]
+                        self._updateRate()
+                        self.switches += 1
+                        if self.select.use == 'prg':
+                                self.select.getTimeline()
                         return True
                 return False
 
         ##
-        # Returns the next Step to execute.
+        # Advances the program clock to now and returns it. The program clock runs at the rate of
+        # the selected program times the warp, the motor functions are evaluated on it.
+        # @returns      the program time in ms
+        def _progTime(self):
+                now = self.clock.now()
+                if self.paused:
+                        self.pclock_ref = now
+                self.pclock += (now - self.pclock_ref)*self.rate
+                self.pclock_ref = now
+                return int(self.pclock)
+
+        ##
+        # Recomputes the playback rate from the selected program and the warp, the program clock
+        # must be current.
+        def _updateRate(self):
+                self.rate = self.warp
+                if self.select != None:
+                        self.rate *= self.select.getRate()
+
+        ##
+        # Moves the selected 'prg' program to the Step playing at t ms program time, counted from the
+        # start of its setup section. Looping programs wrap around into their prg section, others stop
+        # at their last Step. The Step is executed on the next tick and the following ones keep the
+        # phase, as if the program had been played from the start.
+        # @param t      the time in ms
+        # @returns      the index of the Step in the Timeline or None if no 'prg' program is selected
+        def seek(self, t):
+                if self.select == None or self.select.use != 'prg':
+                        return None
+                tl = self.select.getTimeline()
+                if len(tl) == 0:
+                        return None
+                t = max(int(t), 0)
+                start = tl.loopStart()
+                if t >= tl.duration and self.select.looping and tl.duration > start:
+                        t = start + (t - start) % (tl.duration - start)
+                idx = tl.find(t)
+                self._seekIndex(tl, idx, min(max(t - tl.starts[idx], 0), tl.steps[idx].delay))
+                return idx
+
+        ##
+        # Moves the selected 'prg' program to a Step, see seek().
+        # @param idx    the index of the Step in the Timeline, it is clamped
+        # @returns      the index or None if no 'prg' program is selected
+        def seekStep(self, idx):
+                if self.select == None or self.select.use != 'prg':
+                        return None
+                tl = self.select.getTimeline()
+                if len(tl) == 0:
+                        return None
+                idx = min(max(int(idx), 0), len(tl) - 1)
+                self._seekIndex(tl, idx, 0)
+                return idx
+
+        def _seekIndex(self, tl, idx, skip):
+                if idx < tl.setup:
+                        self.inited = 0
+                        self.pos = idx
+                else:
+                        self.inited = 1
+                        self.pos = idx - tl.setup
+                self.blend = []
+                self.skip = skip
+                self.should_stop = False
+                self.time = self.clock.now()
+                self.remaining = 0
+                self.setNextDiff(0)
+
+        ##
+        # Holds the program, the time left until the next Step and the program clock are kept.
+        # @returns      False if already paused
+        def pause(self):
+                if self.paused:
+                        return False
+                self._progTime()
+                self.remaining = max(self.getDeadline() - self.clock.now(), 0)
+                self.paused = True
+                return True
+
+        ##
+        # Continues a paused program, the next Step follows after the time which was left.
+        # @returns      False if not paused
+        def resume(self):
+                if not self.paused:
+                        return False
+                self.paused = False
+                self.pclock_ref = self.clock.now()
+                self.time = self.clock.now()
+                self.setNextDiff(self.remaining)
+                return True
+
+        ##
+        # Changes the playback rate of the running program by factor, the change takes effect
+        # at the next Step boundary.
+        # @param factor the factor, 1.0 is normal speed
+        # @returns      False if the factor is not positive
+        def setWarp(self, factor):
+                factor = float(factor)
+                if factor <= 0:
+                        return False
+                self.next_warp = factor
+                return True
+
+        ##
+        # Prepares a program to take over from the running one without a stop. The program is
+        # encoded right away and switched in at the given boundary, skipping its setup section.
+        # Optionally `blend` Steps are generated, which move linearly from the current pose to the
+        # first pose of the new program. If no program is running, it is simply selected.
+        # @param name   the name of the program
+        # @param at     the boundary, either SWITCH_CYCLE or SWITCH_STEP
+        # @param blend  the number of Steps to generate for the transition
+        # @returns      wheter the program exists
+        def prepareProgram(self, name, at = SWITCH_CYCLE, blend = 0):
+                if not name in self.prgs:
+                        return False
+                if self.select == None:
+                        return self.selectProgram(name)
+                prg = self.prgs[name]
+                prg.encode()
+                self.pending = prg
+                self.pending_at = at
+                self.pending_blend = blend
+                self.pending_repeats = 0
+                self.pending_queued = False
+                return True
+
+        ##
+        # Adds a program to the playlist. The playlist is played in order, every entry after the
+        # previous one has ended, without a pause between them. An entry with repeats greater than
+        # zero (0) plays its prg section that many times regardless of its 'Looping', otherwise the
+        # program decides itself when it ends.
+        # @param name           the name of the program
+        # @param repeats        the number of cycles to play
+        # @param index          the position to insert at, None appends
+        # @returns              wheter the program exists
+        def queueProgram(self, name, repeats = 0, index = None):
+                if not name in self.prgs:
+                        return False
+                if index == None:
+                        index = len(self.playlist)
+                self.playlist.insert(index, (name, int(repeats)))
+                if index == 0:
+                        self._dropQueued()
+                return True
+
+        ##
+        # Removes an entry from the playlist.
+        # @param index  the position of the entry
+        # @returns      wheter the entry existed
+        def dequeueProgram(self, index):
+                if index < 0 or index >= len(self.playlist):
+                        return False
+                self.playlist.pop(index)
+                if index == 0:
+                        self._dropQueued()
+                return True
+
+        ##
+        # Removes all entries from the playlist.
+        def clearQueue(self):
+                self.playlist = []
+                self._dropQueued()
+
+        ##
+        # Forgets the prefetched playlist entry, so it gets prefetched anew.
+        def _dropQueued(self):
+                if self.pending_queued:
+                        self.pending = None
+                        self.pending_queued = False
+
+        ##
+        # Prepares the head of the playlist as pending program, if there is none yet.
+        # If nothing is selected at all the entry is selected right away, including its setup section.
+        def _prefetch(self):
+                if self.pending != None or len(self.playlist) == 0:
+                        return
+                name, repeats = self.playlist[0]
+                if not name in self.prgs:
+                        self.logger.warn('skipping unknown program in queue: ' + name)
+                        self.playlist.pop(0)
+                        return
+                if self.select == None:
+                        self.playlist.pop(0)
+                        self.selectProgram(name)
+                        self.repeats = repeats
+                        return
+                prg = self.prgs[name]
+                prg.encode()
+                self.pending = prg
+                self.pending_at = FileWalker.SWITCH_END
+                self.pending_blend = 0
+                self.pending_repeats = repeats
+                self.pending_queued = True
+
+        ##
+        # Decides at the end of a cycle wheter the selected program starts another one.
+        # @returns      True if the program loops
+        def _nextCycle(self):
+                if self.should_stop:
+                        return False
+                if self.repeats > 0:
+                        self.cycles += 1
+                        return self.cycles < self.repeats
+                return self.select.looping
+
+        ##
+        # Checks if the running program has reached the boundary at which the pending one may take over.
+        # Programs using motor functions have no discrete cycles, they switch on the next Step.
+        # @returns      True if the switch may happen now
+        def _atBoundary(self):
+                if self.pending_at == FileWalker.SWITCH_STEP or self.select == None:
+                        return True
+                if self.pending_at == FileWalker.SWITCH_END:
+                        return False
+                if self.select.use == 'prg':
+                        return self.inited == 1 and self.pos == 0
+                return True
+
+        ##
+        # Generates Steps moving linearly from one pose to another, neither end is included.
+        # @param frm    the Step to start at
+        # @param to     the Step to end at
+        # @param n      the number of Steps
+        # @param delay  the delay of each Step
+        # @returns      the list of Steps
+        def _blendSteps(self, frm, to, n, delay):
+                steps = []
+                if frm == None or to == None:
+                        return steps
+                for k in range(1, n + 1):
+                        stp = Step()
+                        stp.setDelayMs(delay)
+                        for i in range(0, len(stp.pos)):
+                                stp.setServoAtRaw(i, frm.pos[i] + (to.pos[i] - frm.pos[i])*k // (n + 1))
+                        stp.getFrames()
+                        steps.append(stp)
+                return steps
+
+        ##
+        # Makes the pending program the selected one, queueing the transition Steps if requested.
+        def _switch(self):
+                prg = self.pending
+                self.pending = None
+                if self.pending_queued:
+                        self.playlist.pop(0)
+                        self.pending_queued = False
+                self.repeats = self.pending_repeats
+                self.cycles = 0
+                first = prg.firstStep()
+                delay = prg.tick
+                if delay <= 0 and first != None:
+                        delay = first.delay
+                self.blend = self._blendSteps(self.last_step, first, self.pending_blend, delay)
+                now = self._progTime()
+                self.select = prg
+                self._updateRate()
+                self.should_stop = False
+                self.pos = 0
+                self.inited = 1
+                self.starttime = now + len(self.blend)*delay
+                for fcs in prg.mot_fcs:
+                        fcs.last_time = self.starttime
+                self.switches += 1
+                self.logger.debug('switched to program: ' + prg.name)
+
+        ##
+        # Returns the next Step to execute, switching to the pending program when its boundary
+        # has been reached or the running program has ended. Transition Steps come first.
+        # The next playlist entry is prefetched while the current one runs.
+        # @returns      the next Step
+        def getNextStep(self):
+                self._prefetch()
+                if self.pending != None and self._atBoundary():
+                        self._switch()
+                if len(self.blend) > 0:
+                        return self.blend.pop(0)
+                stp = self._getProgramStep()
+                if stp == None and self.select != None and not self.select.complete:
+                        return None
+                if stp == None and self.pending != None:
+                        self._switch()
+                        if len(self.blend) > 0:
+                                return self.blend.pop(0)
+                        stp = self._getProgramStep()
+                return stp
+
+        ##
+        # Returns the next Step of the selected program.
         # If 'Use' is set to 'prg', then the normal program cycle is used for generating, otherwise
         # the motor functions. Since every Program has an init instruction, this will first be
         # executed and then the normal program. If the 'Looping' is set to true, then, after completing
@@ -758,11 +2207,12 @@ class FileWalker(Walker):
         # - a program must be selected>        # - the timedifference must be higher or equal to the one specified by the previous Step
         # - if last instruction is reached: looping must be enabled
         # @returns      the next Step
-        def getNextStep(self):
+        def _getProgramStep(self):
                 if self.select == None:
                         return None
 
                 if self.select.use == 'mot':
+                        now = self._progTime()
                         if self.inited == 0:
                                 lis = self.select.init_steps
                                 if self.pos >= len(lis):
@@ -772,37 +2222,41 @@ class FileWalker(Walker):
                                 if self.pos == len(lis) and self.inited == 0:
                                         self.inited = 1
                                         self.pos = 0
-                                        self.starttime = _getTime()
+                                        self.starttime = now
                                         for i in range(0, len(self.select.mot_fcs)):
                                                 self.select.mot_fcs[i].last_time = self.starttime
 
                         stp = Step()
                         stp.setDelayMs(self.select.tick)
                         for i in range(0, len(self.select.mot_fcs)):
-                                d = self.select.mot_fcs[i].getNextPos(self.select.looping and not self.should_stop)
+                                d = self.select.mot_fcs[i].getNextPos(self.select.looping and not self.should_stop, now)
                                 if d == None:
                                         return None
                                 stp.setServoAtRaw(i, d)
                         return stp
 
                 elif self.select.use == 'prg':
-                        # make sure to init
+                        # make sure to init, generated programs may have no setup section
+                        if self.inited == 0 and len(self.select.init_steps) == 0:
+                                self.inited = 1
                         if self.inited == 0:
                                 lis = self.select.init_steps
                         else:
                                 lis = self.select.prg_steps
                         if self.pos >= len(lis):
-                                return None
+                                # the end was reached while the program was still being loaded
+                                if self.inited == 1 and self.select.complete and len(lis) > 0 and self._nextCycle():
+                                        self.pos = 0
+                                else:
+                                        return None
                         nstp = lis[self.pos]
                         self.pos += 1
                         if self.pos == len(lis):
                                 if self.inited == 0:
                                         self.inited = 1
                                         self.pos = 0
-                                elif self.select.looping and not self.should_stop:
+                                elif self.select.complete and self._nextCycle():
                                         self.pos = 0
-                                else:
-                                        return None
                         return nstp
 
         ##
@@ -810,18 +2264,14 @@ class FileWalker(Walker):
         # @param stp    the Step to send
         def doStep(self, stp):
                 self.logger.debug(str(stp))
+                self.last_step = stp
                 if self.motd == None:
                         return
 
-                # print('---')
-                for i in range(0, 12):
-                        # print str(i/4 + 1) + '/' + str(i%4)
-                        self.motd.reset()
-                        self.motd.setMode(0)
-                        self.motd.setPicAddr(i / 4 + 1) # thru nr of pics ( 4 ) + offset ( 1 )
-                        self.motd.setServoAddr(i % 4)
-                        self.motd.setServoVal(stp.getRawVal(i))
-                        self.motd.send()
+                # the frames are addressed thru nr of pics ( 4 ) + offset ( 1 ), see _encode_step
+                t0 = tracing.DefaultTracer.stamp()
+                self.motd.sendFrames(stp.getFrames())
+                tracing.DefaultTracer.add('doStep', t0)
 
         ##
         # Sets the next target time difference.
@@ -829,32 +2279,79 @@ class FileWalker(Walker):
         def setNextDiff(self, diff):
                 self.target_diff = diff
 
+        ##
+        # Returns the time at which the next Step is due.
+        # @returns      the deadline in ms
+        def getDeadline(self):
+                return self.time + self.target_diff
+
         ##
         # Executes a tick in the FileWalker. This method only does anything if:
         # - a program is selected
         # - the time difference requirement is met
         # and getNextStep() returns a valid Step
         def doTick(self):
-                # print(self.motd.uart.read());
-                if self.select == None:
+                if self.motd != None:
+                        for ev in self.motd.getEvents():
+                                self.logger.debug('uart: ' + repr(ev))
+                if self.select == None and len(self.playlist) == 0:
+                        return
+                if self.paused:
                         return
 
-                if _getTime() - self.time < self.target_diff:
+                if self.clock.now() - self.time < self.target_diff:
                         return
 
-                sttime = _getTime()
+                sttime = self.clock.now()
+                self.lateness = sttime - self.time - self.target_diff
+                if self.next_warp != None:
+                        self._progTime()
+                        self.warp = self.next_warp
+                        self.next_warp = None
+                        self._updateRate()
+                if tracing.DefaultTracer.enabled:
+                        tracing.DefaultTracer.begin()
                 stp = self.getNextStep()
                 if stp != None:
                         self.is_stop = False
                         self.doStep(stp)
-                        self.setNextDiff(stp.delay)
-                else:
+                        self.steps += 1
+                        self.setNextDiff(int(round((stp.delay - self.skip) / self.rate)))
+                        self.skip = 0
+                elif self.select != None and not self.select.complete:
+                        # the program is still being loaded, wait for its next Step
+                        self.setNextDiff(0)
+                elif self.select != None:
                         self.is_stop = True
-                        self.setNextDiff(self.select.tick)
+                        self.setNextDiff(int(round(self.select.tick / self.rate)))
                         self.selectProgram(None)
 
-                self.logger.debug('exec_time: ' + str(_getTime() - sttime))
-                self.time = _getTime()
+                self.logger.debug('exec_time: ' + str(self.clock.now() - sttime))
+                self.time = self.clock.now()
+
+##
+# Runs a program of a FileWalker to its end on a VirtualClock, jumping from one deadline to the
+# next instead of waiting. Looping programs never end on their own, they need a limit.
+# @param fw     the FileWalker, its clock must be a VirtualClock
+# @param name   the name of the program
+# @param limit  the maximum (virtual) run time in ms, zero (0) for none
+# @returns      the number of executed Steps or None if there is no such program
+def simulate(fw, name, limit = 0):
+        if not fw.selectProgram(name):
+                return None
+        fw.setNextDiff(0)
+        fw.time = fw.clock.now()
+        start = fw.clock.now()
+        steps = 0
+        while True:
+                fw.clock.jump(fw.getDeadline())
+                fw.doTick()
+                if fw.is_stop:
+                        break
+                steps += 1
+                if limit > 0 and fw.clock.now() - start >= limit:
+                        break
+        return steps
 
 #
 # CODE